@@ -0,0 +1,344 @@
+"""
+Offline benchmarks of the picturebot against local stand-ins for the reddit and the Telegram Bot API.
+
+Measures the latency of Picturebot.send_picture, the throughput of Picturebot.send_batch and of
+Picturebot.process_commands under bursts of updates and the cost of storing and loading history data as it grows.
+
+Usage: python3 benchmarks/bench_picturebot.py [--sends 200] [--latency 0.05] [--payload-kb 300] ...
+"""
+
+import argparse
+import email
+import email.policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import pickle
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pic_bot  # pylint: disable=wrong-import-position
+
+
+class StandInServer:
+    """Runs a request handler class on a local port in a background thread."""
+
+    def __init__(self, handler_class):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        """Returns the base URL of the server."""
+        return 'http://127.0.0.1:%d' % self.server.server_port
+
+    def start(self):
+        """Starts serving requests."""
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving requests."""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RedditHandler(BaseHTTPRequestHandler):
+    """Serves /r/<subreddit>/new.json listings with configurable latency, payload size and error rate."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    latency = 0.0
+    payload_kb = 300
+    error_rate = 0.0
+    requests = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Answers a listing request."""
+        with RedditHandler.lock:
+            RedditHandler.requests += 1
+        time.sleep(self.latency)
+
+        parts = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(parts.query)
+        if random.random() < self.error_rate:
+            self._send(503, b'{"message": "Service Unavailable"}')
+            return
+
+        subreddit = parts.path.split('/')[2]
+        page = int(query.get('after', ['page_0'])[0].split('_')[-1])
+        etag = '"%s-%d"' % (subreddit, page)
+        if self.headers.get('If-None-Match') == etag:
+            self._send(304, b'', etag)
+            return
+        limit = int(query.get('limit', ['25'])[0])
+        self._send(200, RedditHandler.listing(subreddit, page, limit), etag)
+
+    @classmethod
+    def listing(cls, subreddit, page, limit):
+        """Returns the json of a listing page whose size is about payload_kb."""
+        padding = 'x' * max(0, cls.payload_kb * 1024 // limit - 400)
+        children = []
+        for i in range(limit):
+            number = page * limit + i
+            children.append({'kind': 't3', 'data': {
+                'id': '%s_%d' % (subreddit, number),
+                'title': 'Post %d of %s' % (number, subreddit),
+                'url': 'https://i.redd.it/%s_%d.jpg' % (subreddit, number),
+                'selftext': padding,
+                'preview': {'images': [{'source': {'url': 'https://preview.redd.it/%d.jpg' % number}}]}}})
+        return json.dumps({'kind': 'Listing',
+                           'data': {'after': 'page_%d' % (page + 1), 'children': children}}).encode('utf-8')
+
+    def _send(self, status, body, etag=None):
+        self.send_response(status)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TelegramHandler(BaseHTTPRequestHandler):
+    """Answers the Bot API methods used by the picturebot with configurable latency and error rate."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    latency = 0.0
+    error_rate = 0.0
+    updates = []
+    sent = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Answers a Bot API request."""
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        fields = TelegramHandler._parse_fields(self.headers.get('Content-Type', ''), body)
+        method = self.path.rsplit('/', 1)[-1]
+        time.sleep(self.latency)
+
+        if method != 'getUpdates' and random.random() < self.error_rate:
+            self._send({'ok': False, 'error_code': 500, 'description': 'Internal Server Error'})
+            return
+
+        if method == 'getUpdates':
+            offset = int(fields.get('offset', 0))
+            with TelegramHandler.lock:
+                result = [update for update in TelegramHandler.updates if update['update_id'] >= offset][:100]
+        elif method == 'getChatMember':
+            result = {'status': 'administrator'}
+        else:
+            with TelegramHandler.lock:
+                TelegramHandler.sent += 1
+                message_id = TelegramHandler.sent
+            result = {'message_id': message_id, 'chat': {'id': int(fields.get('chat_id', 0))}}
+            if method == 'sendPhoto':
+                result['photo'] = [{'file_id': 'photo_%d' % message_id}]
+            elif method == 'sendVideo':
+                result['video'] = {'file_id': 'video_%d' % message_id}
+        self._send({'ok': True, 'result': result})
+
+    @staticmethod
+    def _parse_fields(content_type, body):
+        """Returns the form fields of a multipart or url encoded request body."""
+        if content_type.startswith('multipart/form-data'):
+            message = email.message_from_bytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body,
+                                               policy=email.policy.HTTP)
+            return {part.get_param('name', header='content-disposition'): part.get_content()
+                    for part in message.iter_parts()}
+        return {key: values[0] for key, values in urllib.parse.parse_qs(body.decode()).items()}
+
+    def _send(self, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def write_config(reddit_url, telegram_url, args):
+    """Writes a config.json for the stand-ins into the working directory and returns its name."""
+    subreddits = ['bench%d' % i for i in range(args.subreddits)]
+    config = {'group_id': -1, 'test_group_id': -2, 'bot_token': '1:bench',
+              'subreddits': subreddits,
+              'triggers': [{'cron': '0 0 * * *'}],
+              'reddit_url': reddit_url,
+              'telegram_api_url': telegram_url,
+              'listing_cache_ttl': args.cache_ttl,
+              'reddit_rate': 100000,
+              'reddit_burst': 100000,
+              'reddit_max_backoff': 0.1,
+              'long_poll_timeout': 0,
+              'telegram_global_rate': 100000,
+              'telegram_group_rate': 6000000,
+              'telegram_private_rate': 100000}
+    with open('config.json', 'w') as handle:
+        json.dump(config, handle)
+    return 'config.json'
+
+
+def percentiles(samples):
+    """Returns p50, p90 and p99 of the samples in milliseconds."""
+    if len(samples) < 2:
+        return [samples[0] * 1000] * 3 if samples else [0.0] * 3
+    cuts = statistics.quantiles(samples, n=100)
+    return [cuts[49] * 1000, cuts[89] * 1000, cuts[98] * 1000]
+
+
+def bench_send_picture(picbot, args):
+    """Measures the latency of sequential send_picture calls, counting the calls which raised."""
+    samples = []
+    errors = 0
+    for _ in range(args.sends):
+        start = time.perf_counter()
+        try:
+            picbot.send_picture()
+        except Exception:  # pylint: disable=broad-except
+            errors += 1
+        samples.append(time.perf_counter() - start)
+    p50, p90, p99 = percentiles(samples)
+    print('send_picture       %5d calls   p50 %8.2f ms   p90 %8.2f ms   p99 %8.2f ms   %d errors'
+          % (len(samples), p50, p90, p99, errors))
+
+
+def bench_send_batch(picbot, args):
+    """Measures the throughput of a batch send over all subreddits."""
+    subreddits = ['bench%d' % i for i in range(args.subreddits)]
+    report = picbot.send_batch(subreddits, args.batch)
+    print('send_batch         %5d posts   %8.2f s   %8.1f posts/s   %d skipped   %d failed'
+          % (report['sent'], report['seconds'], report['sent'] / report['seconds'],
+             report['skipped'], report['failed']))
+
+
+def bench_process_commands(picbot, args):
+    """Measures how fast a burst of commands is processed, counting the polls which raised."""
+    first_id = 1000
+    with TelegramHandler.lock:
+        TelegramHandler.updates = [
+            # distinct parameters, so no update is coalesced with another one
+            {'update_id': first_id + i,
+             'message': {'message_id': i, 'text': '/picbot source %d' % i,
+                         'chat': {'id': -1, 'type': 'group'},
+                         'from': {'id': 42, 'first_name': 'Bench', 'last_name': 'Mark'}}}
+            for i in range(args.burst)]
+    last_id = first_id + args.burst - 1
+    sent_before = TelegramHandler.sent
+
+    # pylint: disable=protected-access
+    start = time.perf_counter()
+    polls = 0
+    errors = 0
+    while picbot._update_consumer.last_update_id != last_id:
+        try:
+            picbot.process_commands()
+        except Exception:  # pylint: disable=broad-except
+            errors += 1
+        polls += 1
+    # commands run on the worker pool of the bot
+    while picbot._running_commands:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    print('process_commands   %5d updates in %d polls   %8.1f updates/s   %d replies   %d errors'
+          % (args.burst, polls, args.burst / elapsed, TelegramHandler.sent - sent_before, errors))
+
+
+def bench_history(args):
+    """Measures store and load of the pickled history data and the indexed history store as it grows."""
+    nvm = pic_bot.NvMHandler()
+    for size in args.history_sizes:
+        data = {'bench%d' % sub: ['post_%d' % i for i in range(size)] for sub in range(args.subreddits)}
+        start = time.perf_counter()
+        nvm.store(data, 'bench.pickle')
+        stored = time.perf_counter()
+        nvm.load('bench.pickle')
+        loaded = time.perf_counter()
+
+        history = pic_bot.HistoryStore('bench_%d.db' % size, depth=size, legacy_filename=None)
+        start_fill = time.perf_counter()
+        history.add_many([(sub, post_id) for sub, post_ids in data.items() for post_id in post_ids])
+        filled = time.perf_counter()
+        # new posts beyond the depth, so every add also prunes the oldest entry
+        for i in range(args.history_ops):
+            history.add('bench%d' % (i % args.subreddits), 'post_new_%d' % i)
+        added = time.perf_counter()
+        for i in range(args.history_ops):
+            history.contains('bench%d' % (i % args.subreddits), 'post_%d' % (i * 7 % size))
+        checked = time.perf_counter()
+        history.close()
+        print('history %6d/sub   pickle store %8.2f ms   load %8.2f ms   store fill %8.2f ms   '
+              'add %6.3f ms/op   contains %6.4f ms/op'
+              % (size, (stored - start) * 1000, (loaded - stored) * 1000, (filled - start_fill) * 1000,
+                 (added - filled) * 1000 / args.history_ops, (checked - added) * 1000 / args.history_ops))
+
+
+def main():
+    """Starts the stand-ins and runs the benchmarks in a temporary working directory."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sends', type=int, default=200, help='number of send_picture calls')
+    parser.add_argument('--burst', type=int, default=500, help='number of updates per command burst')
+    parser.add_argument('--batch', type=int, default=100, help='number of posts of the batch send')
+    parser.add_argument('--subreddits', type=int, default=10, help='number of subreddits')
+    parser.add_argument('--latency', type=float, default=0.05, help='reddit response delay in seconds')
+    parser.add_argument('--telegram-latency', type=float, default=0.01, help='Telegram response delay in seconds')
+    parser.add_argument('--payload-kb', type=int, default=300, help='size of a listing page in KB')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of failing requests')
+    parser.add_argument('--cache-ttl', type=float, default=60, help='listing cache TTL in seconds')
+    parser.add_argument('--metrics', action='store_true', help='print the collected stage metrics')
+    parser.add_argument('--history-sizes', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                        help='history lengths per subreddit')
+    parser.add_argument('--history-ops', type=int, default=100, help='number of timed history operations')
+    args = parser.parse_args()
+
+    RedditHandler.latency = args.latency
+    RedditHandler.payload_kb = args.payload_kb
+    RedditHandler.error_rate = args.error_rate
+    TelegramHandler.latency = args.telegram_latency
+    TelegramHandler.error_rate = args.error_rate
+
+    reddit = StandInServer(RedditHandler).start()
+    telegram = StandInServer(TelegramHandler).start()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            pic_bot.Logger.get_instance().log.setLevel(logging.WARNING)
+            if args.metrics:
+                pic_bot.Metrics.get_instance().enable()
+            picbot = pic_bot.Picturebot(write_config(reddit.url, telegram.url, args))
+            try:
+                bench_send_picture(picbot, args)
+                bench_send_batch(picbot, args)
+                bench_process_commands(picbot, args)
+                print('reddit requests    %5d   listing cache %s'
+                      % (RedditHandler.requests, picbot._crawler.cache.get_stats()))  # pylint: disable=protected-access
+            finally:
+                picbot.close()
+            if args.metrics:
+                print(pic_bot.Metrics.get_instance().render())
+            bench_history(args)
+        finally:
+            os.chdir(cwd)
+            reddit.stop()
+            telegram.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,49 @@
 """Grabs the latest, not yet sent post from a subreddit and sends it to the given telegram group."""
 
 import argparse
-from datetime import datetime
+import collections
+import concurrent.futures
+import contextlib
+from datetime import datetime, timedelta
+import gzip
+import hashlib
+import heapq
+import html
+import io
+import itertools
+import http.client
+import http.server
 import json
 import logging
+import multiprocessing
+import multiprocessing.connection
+import os
 import pickle
+import queue
 import random
 import re
+import signal
+import sqlite3
 import time
-import urllib.request
+import threading
+import urllib.parse
 import socket 
 import traceback
 
 import telepot
 
+try:
+    from PIL import Image
+except ImportError:  # near duplicate detection is disabled without Pillow
+    Image = None
+
 
 class Logger:
     """ Logging singleton to provide a single logger for all classes"""
     __instance = None
+    # log file, set before the first get_instance to log elsewhere, e.g. per worker process
+    filename = 'picturebot.log'
+    filemode = 'w'
 
     @staticmethod
     def get_instance():
@@ -36,8 +62,8 @@ class Logger:
         logging.basicConfig(level=logging.DEBUG,
                             format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
                             datefmt='%m-%d %H:%M',
-                            filename='picturebot.log',
-                            filemode='w')
+                            filename=Logger.filename,
+                            filemode=Logger.filemode)
         # define a Handler which writes INFO messages or higher to the sys.stderr
         console = logging.StreamHandler()
         console.setLevel(logging.INFO)
@@ -63,17 +89,179 @@ class Logger:
         self.log.error(msg, *args, **kwargs)
 
 
+class _NullTimer:
+    """Timer context of disabled metrics, doing nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _StageTimer:
+    """Timer context adding its duration to a stage of the metrics."""
+
+    __slots__ = ('metrics', 'labels', 'start')
+
+    def __init__(self, metrics, labels):
+        self.metrics = metrics
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe('stage_seconds', time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Metrics:
+    """
+    Metrics singleton collecting counters, gauges and stage timings of all classes.
+    Exported in the Prometheus text format via HTTP or a periodically written file.
+    All calls return immediately while the metrics are disabled.
+    """
+    __instance = None
+
+    PREFIX = 'picturebot_'
+    _NULL_TIMER = _NullTimer()
+
+    @staticmethod
+    def get_instance():
+        """ Static access method. """
+        if Metrics.__instance is None:
+            Metrics()
+        return Metrics.__instance
+
+    def __init__(self):
+        """ Virtually private constructor. """
+        if Metrics.__instance is not None:
+            raise Exception("This class is a singleton!")
+        Metrics.__instance = self
+
+        self.enabled = False
+        self._types = {}
+        self._bases = {}
+        self._values = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._flush_thread = None
+
+    def enable(self, port=None, filename=None, flush_interval=60, host='127.0.0.1'):
+        """
+        Starts collecting and exporting via HTTP on host:port and/or to filename every flush_interval seconds.
+        The HTTP server is only reachable locally unless another host, e.g. '' for all interfaces, is given.
+        """
+        self.enabled = True
+        if port and self._server is None:
+            self._server = http.server.ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+            threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True).start()
+        if filename and self._flush_thread is None:
+            self._flush_thread = threading.Thread(target=self._flush, args=(filename, flush_interval),
+                                                  name='metrics-flush', daemon=True)
+            self._flush_thread.start()
+
+    def inc(self, name, value=1, **labels):
+        """Increases the counter name with the given labels."""
+        if self.enabled:
+            self._add(name, 'counter', labels, value)
+
+    def set(self, name, value, **labels):
+        """Sets the gauge name with the given labels."""
+        if self.enabled:
+            key = (name, tuple(sorted(labels.items())))
+            with self._lock:
+                self._types[name] = 'gauge'
+                self._bases[name] = name
+                self._values[key] = value
+
+    def observe(self, name, seconds, **labels):
+        """Adds a duration to the summary name with the given labels."""
+        if self.enabled:
+            self._add(name + '_count', 'summary', labels, 1, name)
+            self._add(name + '_sum', 'summary', labels, seconds, name)
+
+    def time(self, stage):
+        """Returns a context manager timing the given stage."""
+        if not self.enabled:
+            return Metrics._NULL_TIMER
+        return _StageTimer(self, {'stage': stage})
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), value in sorted(self._values.items()):
+                base = self._bases[name]
+                if base not in typed:
+                    typed.add(base)
+                    lines.append('# TYPE %s%s %s' % (Metrics.PREFIX, base, self._types[base]))
+                label_text = ','.join('%s="%s"' % (key, str(val).replace('"', '\\"')) for key, val in labels)
+                lines.append('%s%s%s %s' % (Metrics.PREFIX, name, '{' + label_text + '}' if label_text else '', value))
+        return '\n'.join(lines) + '\n'
+
+    def _add(self, name, metric_type, labels, value, base=None):
+        """Adds value to the metric name with the given labels."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            # the _count and _sum parts of a summary are typed by the name of their summary
+            self._types[base or name] = metric_type
+            self._bases[name] = base or name
+            self._values[key] = self._values.get(key, 0) + value
+
+    def _flush(self, filename, interval):
+        """Atomically rewrites the metrics file every interval seconds."""
+        while True:
+            time.sleep(interval)
+            tmp_filename = filename + '.tmp'
+            try:
+                with open(tmp_filename, 'w') as handle:
+                    handle.write(self.render())
+                os.replace(tmp_filename, filename)
+            except OSError as e:
+                # retried with the next interval
+                Logger.get_instance().error('Failed to write the metrics file %s: %s', filename, e)
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the metrics on GET /metrics."""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Answers a scrape request."""
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = Metrics.get_instance().render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
 class NvMHandler:
-    """Handles read and write request, as well as a ring buffer for the data."""
+    """Handles read and write request of pickled data."""
 
     def __init__(self):
         self.logger = Logger.get_instance()
 
     def store(self, data, filename='posts.pickle'):
-        """Stores the given data as dump in the file identified by filename."""
+        """Atomically stores the given data as dump in the file identified by filename."""
         self.logger.info('Storing data in %s', filename)
-        with open(filename, 'wb') as handle:
+        # worker processes and threads may store the same file at once
+        tmp_filename = '%s.%s-%s.tmp' % (filename, os.getpid(), threading.get_ident())
+        with open(tmp_filename, 'wb') as handle:
             pickle.dump(data, handle)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(tmp_filename, filename)
 
     def load(self, filename='posts.pickle'):
         """Loads and returns a stored dump identified by filename."""
@@ -86,170 +274,1564 @@ class NvMHandler:
             self.logger.debug('Could not find %s', filename)
             return {}
 
-    def update(self, data, subreddit, post_id):
-        """Updates the given dictionary with the key subreddit and the value post_id."""
-        self.logger.info('Updating data with %s - %s', subreddit, post_id)
-        if subreddit in data:
-            data[subreddit].append(post_id)
-        else:
-            data[subreddit] = [post_id]
-        return self._crop_data(data)
 
-    def _crop_data(self, data, max_length=10):
-        """Reduces the length of the latest posts to the given max_length."""
-        self.logger.info('Cropping data to max %s length', max_length)
-        for key in data:
-            data[key] = data[key][-max_length:]
-        return data
+class HistoryStore:
+    """History of sent posts per subreddit, indexed in memory and persisted incrementally in SQLite."""
 
+    def __init__(self, filename='posts.db', depth=1000, legacy_filename='posts.pickle', shared=False):
+        self.logger = Logger.get_instance()
+        self.depth = depth
+        # other processes add to a shared history, so the database is the authority and memory only a cache
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._index = {}
+
+        self._conn = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS posts ('
+                               'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                               'subreddit TEXT NOT NULL, '
+                               'post_id TEXT NOT NULL, '
+                               'UNIQUE (subreddit, post_id))')
+
+        for subreddit, post_id in self._conn.execute('SELECT subreddit, post_id FROM posts ORDER BY seq'):
+            self._index.setdefault(subreddit, collections.OrderedDict())[post_id] = None
+
+        if not self._index and legacy_filename is not None:
+            self._migrate(legacy_filename)
+        self.logger.info('Loaded history of %s subreddits from %s', len(self._index), filename)
+
+    def contains(self, subreddit, post_id):
+        """Checks if the post was already sent for the given subreddit."""
+        with self._lock:
+            if post_id in self._index.get(subreddit, ()):
+                return True
+            if not self.shared:
+                return False
+            return self._conn.execute('SELECT 1 FROM posts WHERE subreddit = ? AND post_id = ?',
+                                      (subreddit, post_id)).fetchone() is not None
+
+    def add(self, subreddit, post_id):
+        """
+        Remembers the post and forgets the oldest ones exceeding the configured depth.
+        Returns False if the post was already remembered.
+        """
+        return bool(self.add_many([(subreddit, post_id)]))
 
-class RedditCrawler:
-    """Crawler for the reddit API to retrieve posts."""
+    def add_many(self, entries):
+        """
+        Remembers the (subreddit, post_id) entries in a single transaction, like add.
+        Returns the entries which were not remembered yet.
+        """
+        added = []
+        with self._lock, self._conn:
+            for subreddit, post_id in entries:
+                self.logger.info('Updating history with %s - %s', subreddit, post_id)
+                posts = self._index.setdefault(subreddit, collections.OrderedDict())
+                if post_id in posts:
+                    continue
+                posts[post_id] = None
+                dropped = []
+                while len(posts) > self.depth:
+                    dropped.append(posts.popitem(last=False)[0])
+
+                inserted = self._conn.execute('INSERT OR IGNORE INTO posts (subreddit, post_id) VALUES (?, ?)',
+                                              (subreddit, post_id)).rowcount
+                if self.shared:
+                    # the order of the memory index differs per process, so only the database order counts
+                    self._conn.execute('DELETE FROM posts WHERE subreddit = ? AND seq <= '
+                                       '(SELECT seq FROM posts WHERE subreddit = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)',
+                                       (subreddit, subreddit, self.depth))
+                else:
+                    self._conn.executemany('DELETE FROM posts WHERE subreddit = ? AND post_id = ?',
+                                           [(subreddit, dropped_id) for dropped_id in dropped])
+                # otherwise another process claimed the post first
+                if inserted == 1:
+                    added.append((subreddit, post_id))
+        return added
+
+    def get_posts(self, subreddit):
+        """Returns the remembered post ids of the subreddit, oldest first."""
+        with self._lock:
+            if self.shared:
+                return [row[0] for row in self._conn.execute(
+                    'SELECT post_id FROM posts WHERE subreddit = ? ORDER BY seq', (subreddit,))]
+            return list(self._index.get(subreddit, ()))
+
+    def close(self):
+        """Closes the database connection."""
+        with self._lock:
+            self._conn.close()
+
+    def _migrate(self, legacy_filename):
+        """Imports the post ids of the former pickled history."""
+        if not os.path.exists(legacy_filename):
+            return
+        legacy = NvMHandler().load(legacy_filename)
+        self.logger.info('Migrating history from %s', legacy_filename)
+        for subreddit, post_ids in legacy.items():
+            for post_id in post_ids:
+                self.add(subreddit, post_id)
 
-    def __init__(self):
+
+class SharedState:
+    """Values and leases shared by the worker processes of one machine through SQLite."""
+
+    def __init__(self, filename='posts.db'):
         self.logger = Logger.get_instance()
-        self.nvm = NvMHandler()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS leases ('
+                               'name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)')
+
+    def get(self, key, default=None):
+        """Returns the json value stored under key."""
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def set(self, key, value):
+        """Stores the value as json under key."""
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def acquire_lease(self, name, owner, ttl):
+        """
+        Takes or renews the lease name for ttl seconds. Returns False if another owner holds it.
+        The expiry is wall clock time, so all processes of the machine agree on it.
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            acquired = self._conn.execute(
+                'INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires '
+                'WHERE leases.owner = excluded.owner OR leases.expires < ?',
+                (name, owner, now + ttl, now)).rowcount == 1
+        return acquired
 
-    def get_subreddit_posts_from_api(self, subreddit):
-        """Returns the latest posts of the given subreddit"""
-        data = None
+    def release_lease(self, name, owner):
+        """Gives up the lease name if owner holds it."""
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, owner))
 
-        try:
-            req = urllib.request.Request(
-                'https://www.reddit.com/r/' + str(subreddit) + '/new.json?sort=new',
-                data=None,
-                headers={
-                    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_3) \
-                    AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.47 Safari/537.36'
-                })
-            data = json.loads(urllib.request.urlopen(req).read().decode('utf-8'))
-        except urllib.error.HTTPError as err:
-            self.logger.debug('HTTPError: %s', err)
-        return data
-
-    def does_post_match(self, title, regex='.*'):
-        """Checks given post whether its title matches the given regex."""
-        pre_compiled = re.compile(regex)
-        if pre_compiled.match(title) is None:
-            self.logger.info('Title: \'%s\' does not match regex \'%s\'', title, regex)
+    def close(self):
+        """Closes the database connection."""
+        with self._lock:
+            self._conn.close()
+
+
+class HttpResponse:  # pylint: disable=too-few-public-methods
+    """Status, headers and decoded body of a finished HTTP request."""
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        """Returns the body parsed as json."""
+        return json.loads(self.body.decode('utf-8'))
+
+
+class HttpClient:
+    """Keep-alive HTTP client with a bounded connection pool per host."""
+
+    def __init__(self, pool_size=4, connect_timeout=5, read_timeout=30):
+        self.logger = Logger.get_instance()
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._pools = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, headers=None):
+        """Performs a GET request on a pooled connection and returns an HttpResponse."""
+        request_headers = {'Accept-Encoding': 'gzip'}
+        request_headers.update(headers or {})
+        with self.open(url, request_headers) as response:
+            body = response.read()
+            if response.getheader('Content-Encoding', '').lower() == 'gzip':
+                body = gzip.decompress(body)
+            return HttpResponse(response.status, response.headers, body)
+
+    @contextlib.contextmanager
+    def open(self, url, headers=None):
+        """
+        Performs a GET request on a pooled connection and yields the unread response,
+        e.g. to read large bodies in chunks. The connection is only reused if the body was read completely.
+        """
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        request_headers = {'Connection': 'keep-alive'}
+        request_headers.update(headers or {})
+
+        pool, slots = self._get_pool(key)
+        with slots:
+            try:
+                conn, reused = pool.get_nowait(), True
+            except queue.Empty:
+                conn, reused = self._connect(key), False
+            try:
+                response = self._request(conn, path, request_headers)
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if not reused:
+                    raise
+                # the server may have closed the idle connection, retry once on a fresh one
+                self.logger.debug('Stale connection to %s, reconnecting', parts.hostname)
+                conn = self._connect(key)
+                try:
+                    response = self._request(conn, path, request_headers)
+                except (http.client.HTTPException, OSError):
+                    conn.close()
+                    raise
+
+            try:
+                yield response
+            finally:
+                if response.isclosed() and not response.will_close:
+                    pool.put(conn)
+                else:
+                    conn.close()
+
+    def close(self):
+        """Closes all idle pooled connections."""
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            while True:
+                try:
+                    pool.get_nowait().close()
+                except queue.Empty:
+                    break
+
+    def _get_pool(self, key):
+        """Returns the idle connection queue and the slot semaphore of the given host."""
+        with self._lock:
+            if key not in self._pools:
+                self._pools[key] = queue.LifoQueue(self.pool_size)
+                self._slots[key] = threading.BoundedSemaphore(self.pool_size)
+            return self._pools[key], self._slots[key]
+
+    def _connect(self, key):
+        """Opens a new connection using the connect timeout, then switches to the read timeout."""
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=self.connect_timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+
+    @staticmethod
+    def _request(conn, path, headers):
+        """Sends the request on conn and returns the response with its body still unread."""
+        conn.request('GET', path, headers=headers)
+        return conn.getresponse()
+
+
+class ListingCache:
+    """
+    Caches parsed subreddit listings together with their HTTP validators, keyed by (subreddit, after).
+    Holds at most max_entries listings, the least recently used are dropped first.
+    """
+
+    def __init__(self, ttl=60, max_entries=500):
+        self.logger = Logger.get_instance()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.metrics = Metrics.get_instance()
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def get(self, subreddit):
+        """Returns the cached listing of the subreddit if it is younger than the TTL, else None."""
+        with self._lock:
+            entry = self._entries.get(subreddit)
+            if entry is not None and time.monotonic() - entry['fetched_at'] < self.ttl:
+                self._entries.move_to_end(subreddit)
+                self.hits += 1
+                self.metrics.inc('listing_cache_total', result='hit')
+                self.logger.info('Listing cache hit for %s', subreddit)
+                return entry['data']
+            self.misses += 1
+            self.metrics.inc('listing_cache_total', result='miss')
+            return None
+
+    def get_validators(self, subreddit):
+        """Returns the conditional request headers for a stale cached listing."""
+        headers = {}
+        with self._lock:
+            entry = self._entries.get(subreddit)
+            if entry is not None:
+                if entry['etag']:
+                    headers['If-None-Match'] = entry['etag']
+                if entry['last_modified']:
+                    headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, subreddit, data, etag=None, last_modified=None):
+        """Stores a freshly downloaded listing with its validators and drops expired and surplus listings."""
+        now = time.monotonic()
+        with self._lock:
+            self._entries[subreddit] = {'data': data,
+                                        'etag': etag,
+                                        'last_modified': last_modified,
+                                        'fetched_at': now}
+            self._entries.move_to_end(subreddit)
+            # the after cursor of older pages changes with every new post, so expired pages are rarely asked again
+            for key in [key for key, entry in self._entries.items()
+                        if key[1] is not None and now - entry['fetched_at'] >= self.ttl]:
+                del self._entries[key]
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def revalidate(self, subreddit):
+        """Marks the cached listing as fresh again after a 304 and returns it."""
+        with self._lock:
+            entry = self._entries.get(subreddit)
+            if entry is None:
+                return None
+            self.revalidations += 1
+            self.metrics.inc('listing_cache_total', result='revalidation')
+            self.logger.info('Listing of %s not modified, reusing cached data', subreddit)
+            entry['fetched_at'] = time.monotonic()
+            self._entries.move_to_end(subreddit)
+            return entry['data']
+
+    def get_stats(self):
+        """Returns the hit, miss and revalidation counters."""
+        return {'hits': self.hits, 'misses': self.misses, 'revalidations': self.revalidations}
+
+
+class TitleFilter:
+    """Precompiled include and exclude patterns for the post titles of a subreddit."""
+
+    def __init__(self, include=None, exclude=None):
+        self.logger = Logger.get_instance()
+        self.include = TitleFilter._merge(include)
+        self.exclude = TitleFilter._merge(exclude)
+
+    @staticmethod
+    def from_config(value):
+        """Creates a filter from a regex string, a list of regexes or an include/exclude dictionary."""
+        if isinstance(value, dict):
+            return TitleFilter(value.get('include'), value.get('exclude'))
+        if isinstance(value, str):
+            value = [value]
+        return TitleFilter(value)
+
+    def matches(self, title):
+        """Checks if the title matches any include and no exclude pattern."""
+        if self.include is not None and self.include.match(title) is None:
+            return False
+        if self.exclude is not None and self.exclude.match(title) is not None:
             return False
         return True
 
-    def get_post(self, posts, sub_reddit, filter_regex, max_retries=10):
-        """Get the latest not yet sent reddit post, applying a regex filter for gonewild."""
-        latest_posts = self.nvm.load()
+    def filter(self, posts):
+        """Returns the posts whose titles pass the filter."""
+        passed = []
+        for post in posts:
+            if self.matches(post.title):
+                passed.append(post)
+            else:
+                self.logger.info('Title: \'%s\' does not pass the filter', post.title)
+        return passed
+
+    # inline global flags at the start of a pattern, e.g. (?i)
+    GLOBAL_FLAGS = re.compile(r'\(\?([aiLmsux]+)\)')
+
+    @staticmethod
+    def _merge(patterns):
+        """
+        Compiles the patterns into a single alternation, None if there are none.
+        Leading inline flags become scoped flags of their alternative. Patterns with groups, whose numbers
+        and names would clash in the alternation, and flags which cannot be scoped keep the patterns
+        compiled on their own.
+        """
+        if not patterns:
+            return None
+        compiled = [re.compile(pattern) for pattern in patterns]
+        if len(compiled) == 1:
+            return compiled[0]
+        if any(pattern.groups for pattern in compiled):
+            return _PatternList(compiled)
+        alternatives = []
+        for pattern in patterns:
+            flags = ''
+            start = 0
+            match = TitleFilter.GLOBAL_FLAGS.match(pattern)
+            while match is not None:
+                flags += match.group(1)
+                start = match.end()
+                match = TitleFilter.GLOBAL_FLAGS.match(pattern, start)
+            if set(flags) & set('aLu'):
+                return _PatternList(compiled)
+            alternatives.append('(?' + ''.join(sorted(set(flags))) + ':' + pattern[start:] + ')')
+        try:
+            return re.compile('|'.join(alternatives))
+        except re.error:
+            return _PatternList(compiled)
+
+
+class _PatternList:  # pylint: disable=too-few-public-methods
+    """Compiled patterns matching like their alternation."""
+
+    __slots__ = ('patterns',)
+
+    def __init__(self, patterns):
+        self.patterns = patterns
+
+    def match(self, string):
+        """Returns the match of the first matching pattern, None if none matches."""
+        for pattern in self.patterns:
+            match = pattern.match(string)
+            if match is not None:
+                return match
+        return None
+
+
+class Post:  # pylint: disable=too-few-public-methods
+    """The fields of a reddit post which are needed to send it."""
+
+    __slots__ = ('post_id', 'title', 'media_url', 'is_video', 'sub_reddit', 'media_file',
+                 'thumbnail_url', 'media_hash')
+
+    def __init__(self, post_id, title, media_url, is_video, sub_reddit, media_file=None, thumbnail_url=None):
+        self.post_id = post_id
+        self.title = title
+        self.media_url = media_url
+        self.is_video = is_video
+        self.sub_reddit = sub_reddit
+        # local copy of the media, set by the media download stage
+        self.media_file = media_file
+        # smallest preview image of the post and its perceptual hash, set by the near duplicate stage
+        self.thumbnail_url = thumbnail_url
+        self.media_hash = None
+
+    def __repr__(self):
+        return 'Post(%r, %r, %r)' % (self.sub_reddit, self.post_id, self.title)
+
+
+class Listing:  # pylint: disable=too-few-public-methods
+    """A page of posts of a subreddit and the cursor of the following page."""
+
+    __slots__ = ('posts', 'after', 'subreddit')
+
+    def __init__(self, posts, after=None, subreddit=None):
+        self.posts = posts
+        self.after = after
+        self.subreddit = subreddit
+
+
+class RedditError(Exception):
+    """Raised if reddit could not deliver a listing, status is the last HTTP status or None."""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class RedditThrottledError(RedditError):
+    """Raised if reddit still throttles the requests after all retries."""
+
+
+class SubredditNotFoundError(RedditError):
+    """Raised if the subreddit does not exist or is not accessible."""
 
-        post = None
 
-        # only iterate over max available entries from subreddit
-        if 'data' in posts and 'children' in posts['data']:
-            max_retries = min(len(posts['data']['children']), max_retries)
-            self.logger.info('Max retries limited to \'%s\'.', max_retries)
+class RedditRateLimiter:
+    """
+    Process-wide limiter of the reddit requests. Requests are spread over the rate limit window reported
+    by the X-Ratelimit headers, and all requests pause during an exponential backoff after 429 or 5xx responses.
+    """
+
+    def __init__(self, rate=1, capacity=5, base_delay=1, max_delay=60):
+        self.logger = Logger.get_instance()
+        self.rate = rate
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._bucket = TokenBucket(rate, capacity)
+        self._blocked_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        while True:
+            with self._lock:
+                wait = self._blocked_until - time.monotonic()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+        self._bucket.acquire()
+
+    def update(self, headers):
+        """Adapts the request rate to the remaining requests and seconds of the window reported by reddit."""
+        try:
+            remaining = float(headers.get('X-Ratelimit-Remaining'))
+            reset = float(headers.get('X-Ratelimit-Reset'))
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            if remaining < 1:
+                self.logger.info('Reddit rate limit used up, pausing %s seconds', reset)
+                self._blocked_until = max(self._blocked_until, time.monotonic() + reset)
+            else:
+                self._bucket.rate = min(self.rate, remaining / max(reset, 1))
+
+    def backoff(self, attempt, retry_after=None):
+        """Pauses all requests for a jittered exponential delay, or the delay requested by reddit."""
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        if retry_after is not None:
+            delay = min(self.max_delay, retry_after)
         else:
-            max_retries = 0
-
-        for i in range(max_retries):
-            self.logger.info('Checking post \'%s\' of \'%s\'.', (i + 1), max_retries)
-            post = self._get_post_at_position(posts, i)
-
-            if post: # not an empty dict
-                post['sub_reddit'] = sub_reddit
-
-                if post['sub_reddit'] in filter_regex:
-                    if not self.does_post_match(post['title'], filter_regex[post['sub_reddit']]):
-                        continue
-                # Post passed regex check
-                if RedditCrawler.is_post_in_latest_posts(latest_posts,
-                                                         post['sub_reddit'],
-                                                         post['post_id']):
-                    continue
+            # full jitter keeps concurrent retries apart
+            delay = random.uniform(delay / 2, delay)
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+        return delay
+
+
+class RedditCrawler:
+    """Crawler for the reddit API to retrieve posts."""
+
+    USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_3) \
+                    AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.47 Safari/537.36'
+
+    def __init__(self, cache_ttl=60, http_client=None, history=None, page_size=25, max_pages=3, cache_size=500,
+                 base_url='https://www.reddit.com', near_duplicates=None, rate_limiter=None, max_retries=3):
+        self.logger = Logger.get_instance()
+        self.base_url = base_url.rstrip('/')
+        self.metrics = Metrics.get_instance()
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.max_retries = max_retries
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RedditRateLimiter()
+        self.cache = ListingCache(cache_ttl, cache_size)
+        self.http = http_client if http_client is not None else HttpClient()
+        self.history = history if history is not None else HistoryStore()
+        # optional NearDuplicateFilter dropping reposts of already sent media
+        self.near_duplicates = near_duplicates
+        self._history_listeners = []
+        self._candidate_listeners = []
+
+    # the keys of the listing json which are needed to build the posts, all others are dropped while parsing
+    LISTING_KEYS = frozenset(['data', 'children', 'after', 'id', 'title', 'url',
+                              'preview', 'reddit_video_preview', 'fallback_url',
+                              'images', 'source', 'resolutions', 'width'])
+
+    def get_subreddit_posts_from_api(self, subreddit, after=None):
+        """
+        Returns a page of the latest posts of the given subreddit as Listing, served from the listing cache if fresh.
+        Without after the newest page is returned, else the page following the post with the fullname after.
+        Throttling, server errors and network errors are retried with backoff. Raises SubredditNotFoundError
+        for unknown or inaccessible subreddits, RedditThrottledError or RedditError if all retries failed.
+        """
+        cache_key = (subreddit, after)
+        listing = self.cache.get(cache_key)
+        if listing is not None:
+            return listing
+
+        headers = {'User-Agent': RedditCrawler.USER_AGENT}
+        query = {'sort': 'new', 'limit': self.page_size}
+        if after is not None:
+            query['after'] = after
+        url = self.base_url + '/r/' + str(subreddit) + '/new.json?' + urllib.parse.urlencode(query)
+
+        error = None
+        conditional = True
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                self.metrics.inc('reddit_retries_total')
+            if conditional:
+                headers.update(self.cache.get_validators(cache_key))
+            self.rate_limiter.acquire()
+            try:
+                with self.metrics.time('reddit_fetch'):
+                    response = self.http.get(url, headers=headers)
+            except (http.client.HTTPException, OSError) as err:
+                self.metrics.inc('reddit_errors_total', kind='network')
+                self.logger.info('Could not reach reddit: %s', err)
+                error = RedditError('Could not reach reddit: %s' % err)
+                # the last attempt raises right away instead of pausing all requests
+                if attempt < self.max_retries:
+                    self.rate_limiter.backoff(attempt)
+                continue
+            self.rate_limiter.update(response.headers)
+
+            if response.status == 200:
+                listing = self.parse_listing(response.body, subreddit)
+                self.cache.store(cache_key, listing,
+                                 response.headers.get('ETag'),
+                                 response.headers.get('Last-Modified'))
+                return listing
+            if response.status == 304:
+                listing = self.cache.revalidate(cache_key)
+                if listing is not None:
+                    return listing
+                # the listing was dropped from the cache meanwhile, so it is fetched in full
+                self.logger.info('Cached listing of %s was dropped, fetching it again', subreddit)
+                error = RedditError('Reddit answered HTTP 304 for a dropped listing of %s' % subreddit, 304)
+                conditional = False
+                headers.pop('If-None-Match', None)
+                headers.pop('If-Modified-Since', None)
+                continue
+
+            self.metrics.inc('reddit_errors_total', kind=str(response.status))
+            self.logger.debug('HTTPError: %s', response.status)
+            if response.status == 429:
+                error = RedditThrottledError('Reddit throttled the requests for %s' % subreddit, 429)
+                if attempt < self.max_retries:
+                    retry_after = response.headers.get('Retry-After')
+                    delay = self.rate_limiter.backoff(attempt, float(retry_after) if
+                                                      retry_after and retry_after.isdigit() else None)
+                    self.logger.info('Reddit throttled the requests, backing off %.1f seconds', delay)
+            elif response.status >= 500:
+                error = RedditError('Reddit failed with HTTP %s' % response.status, response.status)
+                if attempt < self.max_retries:
+                    self.rate_limiter.backoff(attempt)
+            elif response.status in (302, 403, 404):
+                # unknown subreddits are redirected to the search, private and banned ones are forbidden
+                raise SubredditNotFoundError('Subreddit %s is not available' % subreddit, response.status)
+            else:
+                raise RedditError('Reddit answered HTTP %s' % response.status, response.status)
+        raise error
+
+    def parse_listing(self, body, subreddit):
+        """
+        Parses the json body of a listing into a Listing of Posts.
+        Objects are reduced to the needed keys while decoding, so the full object tree is never kept.
+        Raises RedditError if the body is no listing, e.g. an HTML page of a blocked request.
+        """
+        try:
+            with self.metrics.time('json_decode'):
+                data = json.loads(body.decode('utf-8'), object_pairs_hook=RedditCrawler._pick_listing_keys)
+            children = data.get('data', {}).get('children', [])
+            posts = []
+            for i, child in enumerate(children):
+                post = self._parse_post(child.get('data', {}), subreddit)
+                if post is not None:
+                    posts.append(post)
                 else:
-                    self.logger.info('Checked: ' + str(i+1) + ' posts.')
-                    break
+                    self.logger.info('Recieved empty post for entry \'%s\'.', (i + 1))
+            return Listing(posts, data.get('data', {}).get('after'), subreddit)
+        except (ValueError, AttributeError, TypeError) as err:
+            self.metrics.inc('reddit_errors_total', kind='invalid')
+            raise RedditError('Reddit answered no valid listing for %s: %s' % (subreddit, err), 200) from err
+
+    @staticmethod
+    def _pick_listing_keys(pairs):
+        """Builds a json object of only the needed key value pairs."""
+        return {key: value for key, value in pairs if key in RedditCrawler.LISTING_KEYS}
+
+    def get_candidates(self, listing, title_filter=None):
+        """Returns all not yet sent posts of the listing that pass the title filter, in one pass."""
+        with self.metrics.time('title_filter'):
+            eligible = title_filter.filter(listing.posts) if title_filter is not None else listing.posts
+        with self.metrics.time('history_lookup'):
+            candidates = [post for post in eligible
+                          if not self.history.contains(post.sub_reddit, post.post_id)]
+        self.metrics.inc('dedupe_total', len(eligible) - len(candidates), result='duplicate')
+        if self.near_duplicates is not None:
+            unique = self.near_duplicates.filter(candidates)
+            self.metrics.inc('dedupe_total', len(candidates) - len(unique), result='near_duplicate')
+            candidates = unique
+        self.metrics.inc('dedupe_total', len(candidates), result='new')
+        for listener in self._candidate_listeners:
+            listener(listing.subreddit, len(listing.posts), len(eligible), len(candidates))
+
+        self.logger.info('Found %s candidates in %s checked posts.', len(candidates), len(listing.posts))
+        return candidates
+
+    def iter_candidates(self, listing, title_filter=None):
+        """
+        Yields the candidates of the given listing and of the following pages up to max_pages.
+        A following page is only fetched, through the after cursor, once the previous one is used up.
+        """
+        for page in range(1, self.max_pages + 1):
+            yield from self.get_candidates(listing, title_filter)
+            if listing.after is None or page == self.max_pages:
+                return
+            self.logger.info('Fetching page %s of %s', page + 1, listing.subreddit)
+            try:
+                listing = self.get_subreddit_posts_from_api(listing.subreddit, listing.after)
+            except RedditError as err:
+                self.logger.info('Could not fetch page %s of %s: %s', page + 1, listing.subreddit, err)
+                return
+
+    def get_post(self, listing, title_filter=None, accept=None):
+        """
+        Get the latest not yet sent reddit post, applying a title filter for gonewild.
+        Older pages of the subreddit are fetched if the given listing has no adequate post.
+        The optional callable accept(post) can reject posts which cannot be sent.
+        Returns None if there is no adequate post.
+        """
+        for post in self.iter_candidates(listing, title_filter):
+            if accept is not None and not accept(post):
+                continue
+            # another thread may have taken the same post in the meantime
+            if self.mark_post_sent(post):
+                return post
+        return None
+
+    def mark_post_sent(self, post):
+        """
+        Adds the post to the history of sent posts and notifies the history listeners.
+        Returns False if the post was already sent.
+        """
+        return bool(self.mark_posts_sent([post]))
+
+    def mark_posts_sent(self, posts):
+        """
+        Adds the posts to the history in a single transaction, like mark_post_sent.
+        Returns the added posts, except those similar to an already sent one, which stay in the history.
+        """
+        with self.metrics.time('history_store'):
+            added = set(self.history.add_many([(post.sub_reddit, post.post_id) for post in posts]))
+            posts = [post for post in posts if (post.sub_reddit, post.post_id) in added]
+
+        for post in posts:
+            for listener in self._history_listeners:
+                listener(post.sub_reddit, post.post_id)
+
+        if self.near_duplicates is not None:
+            # candidates are checked when gathered, posts queued or batched since may be similar to each other
+            unique = [post for post in posts if self.near_duplicates.add(post)]
+            self.metrics.inc('dedupe_total', len(posts) - len(unique), result='near_duplicate')
+            posts = unique
+        return posts
+
+    def add_history_listener(self, listener):
+        """Registers a callable(subreddit, post_id) which is called whenever a post is marked as sent."""
+        self._history_listeners.append(listener)
+
+    def remove_history_listener(self, listener):
+        """Unregisters a callable registered by add_history_listener."""
+        if listener in self._history_listeners:
+            self._history_listeners.remove(listener)
+
+    def add_candidate_listener(self, listener):
+        """
+        Registers a callable(subreddit, checked, eligible, candidates) which is called with the number of
+        checked posts, posts passing the title filter and not yet sent posts of every searched page.
+        """
+        self._candidate_listeners.append(listener)
+
+    def _parse_post(self, data, subreddit):
+        """Returns the Post of the given reddit api post data, None if it has no media."""
+        try:
+            if 'preview' in data:
+                is_video = 'reddit_video_preview' in data['preview']
+            else:
+                # No media
+                self.logger.info('No parsable media found in post.')
+                return None
+
+            if is_video:
+                media_url = data['preview']['reddit_video_preview']['fallback_url']
             else:
-                self.logger.info('Recieved empty post for entry \'%s\'.', (i + 1))
+                media_url = data['url']
 
-        if post: # not an empty dict
-            latest_posts = self.nvm.update(latest_posts, post['sub_reddit'], post['post_id'])
-            self.nvm.store(latest_posts)
+            title = data['title']
+            post_id = data['id']
 
-        return post
+            if title is not None and media_url is not None and post_id is not None:
+                return Post(post_id, title, media_url, is_video, subreddit,
+                            thumbnail_url=RedditCrawler._get_thumbnail_url(data['preview']))
+        except KeyError as err:
+            self.logger.debug('Error accessing key: %s', err)
+        return None
 
-    def _get_post_at_position(self, posts, i):
-        """Returns the post and its media type at index i of the given json reddit api data"""
-        post = {}
+    @staticmethod
+    def _get_thumbnail_url(preview):
+        """Returns the url of the smallest preview image, also present for videos, None if there is none."""
+        images = preview.get('images') or [{}]
+        resolutions = images[0].get('resolutions') or [images[0].get('source') or {}]
+        url = min(resolutions, key=lambda resolution: resolution.get('width', 0)).get('url')
+        # reddit escapes the query of preview urls as html
+        return html.unescape(url) if url else None
+
+
+class Prefetcher:
+    """Keeps a bounded queue of filtered, not yet sent posts per subreddit, refilled in the background."""
 
-        if posts is not None:
+    def __init__(self, crawler, subreddits, title_filters, queue_size=3, interval=120, workers=4, prepare=None):
+        self.logger = Logger.get_instance()
+        self.metrics = Metrics.get_instance()
+        self.crawler = crawler
+        # optional callable(post) preparing the post for sending, returns False if it cannot be sent
+        self.prepare = prepare
+        self.subreddits = list(subreddits)
+        self.title_filters = title_filters
+        self.queue_size = queue_size
+        self.interval = interval
+        self._queues = {}
+        self._generations = collections.defaultdict(int)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                               thread_name_prefix='prefetch')
+        crawler.add_history_listener(self.invalidate)
+
+    def start(self):
+        """Starts the background thread refreshing all subreddits every interval seconds."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='prefetcher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stops the background refresh and waits for running fetches."""
+        self.crawler.remove_history_listener(self.invalidate)
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._executor.shutdown(wait=True)
+
+    def refresh_all(self):
+        """Refreshes the queues of all subreddits in parallel and waits for completion."""
+        for future in [self._executor.submit(self.refresh, sub) for sub in self.subreddits]:
             try:
-                data = posts['data']['children'][i]['data']
-                if 'preview' in data:
-                    is_video = 'reddit_video_preview' in data['preview']
-                else:
-                    # No media
-                    self.logger.info('No parsable media found in post.')
-                    return {}
+                future.result()
+            except Exception as err:  # pylint: disable=broad-except
+                self.logger.error('Prefetching failed: %s', err)
+
+    def refresh(self, subreddit):
+        """Fetches the subreddit and replaces its queue with the current candidates."""
+        with self._lock:
+            generation = self._generations[subreddit]
+
+        try:
+            listing = self.crawler.get_subreddit_posts_from_api(subreddit)
+        except RedditError as err:
+            self.logger.info('Could not prefetch %s: %s', subreddit, err)
+            return
+        ready = []
+        for post in self.crawler.iter_candidates(listing, self.title_filters.get(subreddit)):
+            if self.prepare is None or self.prepare(post):
+                ready.append(post)
+            if len(ready) == self.queue_size:
+                break
+
+        with self._lock:
+            if generation != self._generations[subreddit]:
+                # history changed while fetching, the candidates may contain a sent post
+                self.logger.debug('Discarding outdated prefetch of %s', subreddit)
+                return
+            self._queues[subreddit] = collections.deque(ready)
+        self.logger.info('Prefetched %s posts of %s', len(ready), subreddit)
+
+    def pop(self, subreddit):
+        """Returns the next ready post of the subreddit, or None if its queue is empty."""
+        with self._lock:
+            posts = self._queues.get(subreddit)
+            if posts:
+                self.metrics.inc('prefetch_total', result='hit')
+                return posts.popleft()
+        self.metrics.inc('prefetch_total', result='miss')
+        return None
+
+    def invalidate(self, subreddit, post_id):
+        """Drops the sent post from the queue of its subreddit and schedules a refill."""
+        with self._lock:
+            self._generations[subreddit] += 1
+            posts = self._queues.get(subreddit)
+            if posts:
+                self._queues[subreddit] = collections.deque(
+                    post for post in posts if post.post_id != post_id)
+        if subreddit in self.subreddits and not self._stop.is_set():
+            try:
+                self._executor.submit(self.refresh, subreddit)
+            except RuntimeError:
+                # stopped meanwhile, the executor takes no more work
+                pass
+
+    def _run(self):
+        """Refresh loop of the background thread."""
+        while not self._stop.is_set():
+            self.refresh_all()
+            self._stop.wait(self.interval)
+
+
+class SubredditStats:  # pylint: disable=too-few-public-methods
+    """Moving averages of the send outcomes and the page yield of a subreddit."""
+
+    __slots__ = ('success', 'pass_rate', 'fresh_rate', 'latency', 'misses', 'cooldown_until')
+
+    def __init__(self):
+        # optimistic start values, so unknown subreddits are tried
+        self.success = 1.0
+        self.pass_rate = 1.0
+        self.fresh_rate = 1.0
+        self.latency = 0.0
+        self.misses = 0
+        self.cooldown_until = 0
+
+
+class SubredditSelector:
+    """
+    Picks the subreddit of a send, weighted by how often it recently delivered a post, how many of its posts
+    pass the title filter and are not yet sent, and how fast it answers.
+    Subreddits which failed max_misses times in a row are left out for cooldown seconds.
+    """
+
+    MIN_WEIGHT = 0.01
+
+    def __init__(self, cooldown=600, max_misses=3, exploration=0.1, smoothing=0.3):
+        self.logger = Logger.get_instance()
+        self.metrics = Metrics.get_instance()
+        self.cooldown = cooldown
+        self.max_misses = max_misses
+        self.exploration = exploration
+        self.smoothing = smoothing
+        self._stats = collections.defaultdict(SubredditStats)
+        self._lock = threading.Lock()
+
+    def select(self, subreddits):
+        """Returns one of the subreddits, the one whose cooldown ends first if all are cooling down."""
+        now = time.monotonic()
+        with self._lock:
+            ready = [sub for sub in subreddits if self._stats[sub].cooldown_until <= now]
+            if not ready:
+                return min(subreddits, key=lambda sub: self._stats[sub].cooldown_until)
+            # a share of uniform picks keeps the statistics of low weighted subreddits current
+            if random.random() < self.exploration:
+                return random.choice(ready)
+            weights = [self._weight(self._stats[sub]) for sub in ready]
+        return random.choices(ready, weights)[0]
+
+    def record_candidates(self, subreddit, checked, eligible, candidates):
+        """Updates the filter pass rate and the share of not yet sent posts of a searched page."""
+        if not checked:
+            return
+        with self._lock:
+            stats = self._stats[subreddit]
+            stats.pass_rate = self._average(stats.pass_rate, eligible / checked)
+            stats.fresh_rate = self._average(stats.fresh_rate, candidates / eligible if eligible else 0.0)
 
-                if is_video:
-                    media_url = data['preview']['reddit_video_preview']['fallback_url']
+    def record_send(self, subreddit, found, latency=None):
+        """
+        Updates the success rate of the subreddit by whether a post was found, and its fetch latency.
+        Puts the subreddit into cooldown after max_misses misses in a row.
+        """
+        with self._lock:
+            stats = self._stats[subreddit]
+            stats.success = self._average(stats.success, 1.0 if found else 0.0)
+            if latency is not None:
+                stats.latency = self._average(stats.latency, latency)
+            stats.misses = 0 if found else stats.misses + 1
+            if stats.misses >= self.max_misses:
+                stats.misses = 0
+                stats.cooldown_until = time.monotonic() + self.cooldown
+                self.logger.info('Subreddit %s delivered no post %s times, cooling down for %s seconds',
+                                 subreddit, self.max_misses, self.cooldown)
+            weight = self._weight(stats)
+        self.metrics.set('subreddit_weight', weight, subreddit=subreddit)
+
+    def get_stats(self, subreddit):
+        """Returns the statistics of the subreddit as dict."""
+        with self._lock:
+            stats = self._stats[subreddit]
+            return {key: getattr(stats, key) for key in SubredditStats.__slots__}
+
+    def _average(self, average, value):
+        """Returns the exponential moving average updated with the value."""
+        return average + self.smoothing * (value - average)
+
+    @staticmethod
+    def _weight(stats):
+        """Returns the selection weight of the statistics of a subreddit."""
+        weight = stats.success * (0.1 + 0.9 * stats.pass_rate * stats.fresh_rate) / (1 + stats.latency)
+        return max(SubredditSelector.MIN_WEIGHT, weight)
+
+
+class TokenBucket:
+    """Thread-safe token bucket holding up to capacity tokens, refilled with rate tokens per second."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, sleeping until it is available. Waiting callers are served in order."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # the token is reserved right away, a negative balance is the wait of later callers
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class TelegramRateLimiter:
+    """Respects the global and the per chat message limits of the Telegram bot API."""
+
+    def __init__(self, global_rate=30, group_rate=20, private_rate=1):
+        self._global = TokenBucket(global_rate, global_rate)
+        # group limits are given per minute
+        self._group_rate = group_rate / 60
+        self._private_rate = private_rate
+        self._chats = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, chat_id):
+        """Blocks until a message may be sent to the given chat."""
+        with self._lock:
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                # groups and channels have negative ids
+                is_group = isinstance(chat_id, int) and chat_id < 0
+                bucket = TokenBucket(self._group_rate if is_group else self._private_rate, 3 if is_group else 1)
+                self._chats[chat_id] = bucket
+        bucket.acquire()
+        self._global.acquire()
+
+
+class FileIdCache:
+    """
+    Persistent LRU cache from media URLs to the Telegram file ids of already uploaded media.
+    The entries are kept in a table of the SQLite history database, shared by the worker processes.
+    """
+
+    # counter of the uses, ordering the entries by their last use across processes
+    _NEXT_USE = 'SELECT COALESCE(MAX(last_used), 0) + 1 FROM file_ids'
+
+    def __init__(self, filename='posts.db', max_size=1000, legacy_filename='file_ids.pickle'):
+        self.logger = Logger.get_instance()
+        self.metrics = Metrics.get_instance()
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS file_ids ('
+                               'media_url TEXT PRIMARY KEY, '
+                               'file_id TEXT NOT NULL, '
+                               'last_used INTEGER NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS file_ids_last_used ON file_ids (last_used)')
+        empty = self._conn.execute('SELECT 1 FROM file_ids LIMIT 1').fetchone() is None
+        if empty and legacy_filename is not None:
+            self._migrate(legacy_filename)
+
+    def get(self, media_url):
+        """Returns the file id of the media, None if it was not uploaded yet."""
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT file_id FROM file_ids WHERE media_url = ?', (media_url,)).fetchone()
+            if row is not None:
+                self._conn.execute('UPDATE file_ids SET last_used = (%s) WHERE media_url = ?' % FileIdCache._NEXT_USE,
+                                   (media_url,))
+        self.metrics.inc('file_id_cache_total', result='hit' if row is not None else 'miss')
+        return row[0] if row is not None else None
+
+    def put(self, media_url, file_id):
+        """Remembers the file id of the media, evicting the least recently used entries."""
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO file_ids (media_url, file_id, last_used) '
+                               'VALUES (?, ?, (%s))' % FileIdCache._NEXT_USE, (media_url, file_id))
+            self._conn.execute('DELETE FROM file_ids WHERE media_url IN '
+                               '(SELECT media_url FROM file_ids ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                               (self.max_size,))
+
+    def discard(self, media_url):
+        """Forgets the file id of the media, e.g. if Telegram rejected it."""
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM file_ids WHERE media_url = ?', (media_url,))
+
+    def close(self):
+        """Closes the database connection."""
+        with self._lock:
+            self._conn.close()
+
+    def _migrate(self, legacy_filename):
+        """Imports the file ids of the former pickled cache, oldest first."""
+        if not os.path.exists(legacy_filename):
+            return
+        legacy = NvMHandler().load(legacy_filename)
+        self.logger.info('Migrating file ids from %s', legacy_filename)
+        for media_url, file_id in legacy.items():
+            self.put(media_url, file_id)
+
+
+class MediaTooLargeError(Exception):
+    """Raised if a media file exceeds the Telegram upload limit."""
+
+
+class MediaCache:
+    """Content addressed disk cache of downloaded media, bounded by a byte budget with LRU eviction."""
+
+    # upload limits of the Telegram bot API
+    PHOTO_LIMIT = 10 * 1024 * 1024
+    VIDEO_LIMIT = 50 * 1024 * 1024
+    CHUNK_SIZE = 64 * 1024
+    MAX_REDIRECTS = 3
+    INDEX_FILE = 'index.pickle'
+    STALE_PART_AGE = 3600
+
+    def __init__(self, http_client, nvm_handler, directory='media_cache', max_bytes=500 * 1024 * 1024):
+        self.logger = Logger.get_instance()
+        self.metrics = Metrics.get_instance()
+        self.http = http_client
+        self.nvm = nvm_handler
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._too_large = set()
+        self._files = collections.OrderedDict()
+        self._total = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._index_path = os.path.join(directory, MediaCache.INDEX_FILE)
+        # cached files of earlier runs, least recently used first
+        for entry in sorted(os.scandir(directory), key=lambda entry: entry.stat().st_mtime):
+            if entry.name.endswith('.part'):
+                # downloads of other worker processes sharing the directory may still be running
+                if entry.stat().st_mtime < time.time() - MediaCache.STALE_PART_AGE:
+                    os.remove(entry.path)
+            elif entry.name != MediaCache.INDEX_FILE:
+                self._files[entry.name] = entry.stat().st_size
+                self._total += self._files[entry.name]
+        self._urls = {url: filename for url, filename in nvm_handler.load(self._index_path).items()
+                      if filename in self._files}
+        self._evict()
+
+    def fetch(self, url, is_video=False):
+        """
+        Returns the local path of the media, downloading it if it is not cached yet.
+        Returns None if the download failed and raises MediaTooLargeError if Telegram would reject the file.
+        """
+        limit = MediaCache.VIDEO_LIMIT if is_video else MediaCache.PHOTO_LIMIT
+        with self._lock:
+            if url in self._too_large:
+                self.metrics.inc('media_cache_total', result='too_large')
+                raise MediaTooLargeError(url)
+            filename = self._urls.get(url)
+            if filename in self._files:
+                self.metrics.inc('media_cache_total', result='hit')
+                self._files.move_to_end(filename)
+                path = os.path.join(self.directory, filename)
+                # the modification time keeps the LRU order across restarts
+                os.utime(path)
+                return path
+
+        self.metrics.inc('media_cache_total', result='miss')
+        try:
+            with self.metrics.time('media_download'):
+                filename, size = self._download(url, limit)
+        except MediaTooLargeError:
+            with self._lock:
+                self._too_large.add(url)
+            raise
+        except (http.client.HTTPException, OSError) as err:
+            self.logger.info('Could not download %s: %s', url, err)
+            return None
+        if filename is None:
+            return None
+
+        with self._lock:
+            self._urls[url] = filename
+            if filename not in self._files:
+                self._total += size
+            self._files[filename] = size
+            self._files.move_to_end(filename)
+            self._evict()
+            self.nvm.store(self._urls, self._index_path)
+        return os.path.join(self.directory, filename)
+
+    def _download(self, url, limit):
+        """Streams the media in chunks into a temporary file and moves it to its content address."""
+        for _ in range(MediaCache.MAX_REDIRECTS + 1):
+            with self.http.open(url, {'User-Agent': RedditCrawler.USER_AGENT,
+                                      'Accept-Encoding': 'identity'}) as response:
+                if response.status in (301, 302, 303, 307, 308):
+                    response.read()
+                    url = urllib.parse.urljoin(url, response.getheader('Location', ''))
+                    continue
+                if response.status != 200:
+                    self.logger.info('Could not download %s: HTTP %s', url, response.status)
+                    return None, 0
+
+                length = response.getheader('Content-Length')
+                if length is not None and int(length) > limit:
+                    raise MediaTooLargeError('%s has %s bytes' % (url, length))
+                return self._store(response, url, limit)
+        self.logger.info('Too many redirects for %s', url)
+        return None, 0
+
+    def _store(self, response, url, limit):
+        """Writes the response body into the cache, named by its SHA-256 digest."""
+        digest = hashlib.sha256()
+        size = 0
+        tmp_path = os.path.join(self.directory, '%s-%s.part' % (os.getpid(), threading.get_ident()))
+        try:
+            with open(tmp_path, 'wb') as handle:
+                while True:
+                    chunk = response.read(MediaCache.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > limit:
+                        raise MediaTooLargeError('%s exceeds %s bytes' % (url, limit))
+                    digest.update(chunk)
+                    handle.write(chunk)
+            extension = os.path.splitext(urllib.parse.urlsplit(url).path)[1][:5]
+            filename = digest.hexdigest() + extension
+            os.replace(tmp_path, os.path.join(self.directory, filename))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.logger.info('Downloaded %s bytes of %s', size, url)
+        return filename, size
+
+    def _evict(self):
+        """Removes the least recently used files until the cache fits into the byte budget."""
+        while self._total > self.max_bytes and len(self._files) > 1:
+            filename, size = self._files.popitem(last=False)
+            self._total -= size
+            self._urls = {url: name for url, name in self._urls.items() if name != filename}
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+
+
+class BKTree:
+    """Burkhard-Keller tree of 64 bit hashes, searched for neighbours within a Hamming distance."""
+
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def distance(hash_a, hash_b):
+        """Returns the number of differing bits of both hashes."""
+        return bin(hash_a ^ hash_b).count('1')
+
+    def add(self, value, item):
+        """Adds the item under the hash value."""
+        self._size += 1
+        if self._root is None:
+            self._root = (value, [item], {})
+            return
+        node = self._root
+        while True:
+            distance = BKTree.distance(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (value, [item], {})
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """Returns the items whose hashes differ in at most max_distance bits from value."""
+        found = []
+        nodes = [self._root] if self._root is not None else []
+        while nodes:
+            node = nodes.pop()
+            distance = BKTree.distance(value, node[0])
+            if distance <= max_distance:
+                found.extend(node[1])
+            # by the triangle inequality only children within the distance band can hold matches
+            nodes.extend(child for child_distance, child in node[2].items()
+                         if distance - max_distance <= child_distance <= distance + max_distance)
+        return found
+
+
+class NearDuplicateFilter:
+    """
+    Detects reposts of already sent media by the difference hash of their preview thumbnails.
+    The hashes of sent posts are persisted in SQLite and indexed across all subreddits in a BK-tree.
+    """
+
+    HASH_SIZE = 8
+    MAX_THUMBNAIL_BYTES = 2 * 1024 * 1024
+    # seconds until a thumbnail which could not be hashed is tried again
+    FAILURE_TTL = 300
+
+    def __init__(self, http_client, filename='posts.db', threshold=6, depth=10000, workers=4):
+        self.logger = Logger.get_instance()
+        self.metrics = Metrics.get_instance()
+        self.http = http_client
+        self.threshold = threshold
+        self.depth = depth
+        self._lock = threading.Lock()
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hash')
+        # hashes of recently seen thumbnails
+        self._hashes = collections.OrderedDict()
+        # thumbnails which could not be hashed, e.g. after a network error, with the time to try them again
+        self._failures = {}
+
+        self._conn = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS media_hashes ('
+                               'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                               'hash TEXT NOT NULL, '
+                               'subreddit TEXT NOT NULL, '
+                               'post_id TEXT NOT NULL)')
+        self._build_tree()
+        self.logger.info('Loaded %s media hashes from %s', len(self._tree), filename)
+
+    def filter(self, posts):
+        """Returns the posts whose media is not similar to an already sent one, hashing new thumbnails in a batch."""
+        self.hash_posts(posts)
+        with self._lock:
+            self._load_new_hashes()
+            unique = []
+            for post in posts:
+                matches = self._tree.search(post.media_hash, self.threshold) if post.media_hash is not None else []
+                if matches:
+                    self.logger.info('Skipping post %s, similar to %s - %s', post.post_id, *matches[0])
                 else:
-                    media_url = data['url']
-
-                title = data['title']
-                post_id = data['id']
-
-                if title is not None and media_url is not None and post_id is not None:
-                    post['title'] = title
-                    post['media_url'] = media_url
-                    post['post_id'] = post_id
-                    post['is_video'] = is_video
-            except KeyError as err:
-                self.logger.debug('Error accessing key: %s', err)
-        else:
-            self.logger.info('Posts are invalid.')
+                    unique.append(post)
+            return unique
+
+    def hash_posts(self, posts):
+        """Sets the media hash of the posts, downloading and hashing unknown thumbnails concurrently."""
+        now = time.monotonic()
+        with self._lock:
+            missing = {post.thumbnail_url for post in posts
+                       if post.thumbnail_url is not None and post.thumbnail_url not in self._hashes
+                       and self._failures.get(post.thumbnail_url, 0) <= now}
+        if missing:
+            with self.metrics.time('perceptual_hash'):
+                hashes = dict(zip(missing, self._pool.map(self._hash_thumbnail, missing)))
+            with self._lock:
+                for url, media_hash in hashes.items():
+                    if media_hash is None:
+                        self._failures[url] = now + NearDuplicateFilter.FAILURE_TTL
+                    else:
+                        self._failures.pop(url, None)
+                        self._hashes[url] = media_hash
+                while len(self._hashes) > self.depth:
+                    self._hashes.popitem(last=False)
+                if len(self._failures) > self.depth:
+                    self._failures = {url: retry_at for url, retry_at in self._failures.items() if retry_at > now}
+        with self._lock:
+            for post in posts:
+                post.media_hash = self._hashes.get(post.thumbnail_url)
+
+    def add(self, post):
+        """
+        Remembers the media hash of the post to be sent.
+        Returns False, without remembering it, if similar media was sent meanwhile, e.g. the same crosspost
+        queued for another subreddit.
+        """
+        if post.media_hash is None:
+            self.hash_posts([post])
+        if post.media_hash is None:
+            return True
+        with self._lock:
+            self._load_new_hashes()
+            matches = self._tree.search(post.media_hash, self.threshold)
+            if matches:
+                self.logger.info('Dropping post %s, similar to %s - %s', post.post_id, *matches[0])
+                return False
+            with self._conn:
+                self._conn.execute('INSERT INTO media_hashes (hash, subreddit, post_id) VALUES (?, ?, ?)',
+                                   ('%016x' % post.media_hash, post.sub_reddit, post.post_id))
+            self._load_new_hashes()
+            # a BK-tree cannot drop entries, so it is rebuilt once a tenth of the depth is exceeded
+            if len(self._tree) > self.depth + self.depth // 10:
+                self._build_tree()
+        return True
 
-        return post
+    def close(self):
+        """Stops the hash workers and closes the database connection."""
+        self._pool.shutdown(wait=True)
+        with self._lock:
+            self._conn.close()
+
+    def _build_tree(self):
+        """Forgets all but the latest depth hashes and indexes them in a new tree."""
+        with self._conn:
+            self._conn.execute('DELETE FROM media_hashes WHERE seq <= '
+                               '(SELECT MAX(seq) FROM media_hashes) - ?', (self.depth,))
+        self._tree = BKTree()
+        self._last_seq = 0
+        self._load_new_hashes()
+
+    def _load_new_hashes(self):
+        """Indexes the hashes stored since the last call, including those of other processes."""
+        for seq, value, subreddit, post_id in self._conn.execute(
+                'SELECT seq, hash, subreddit, post_id FROM media_hashes WHERE seq > ? ORDER BY seq',
+                (self._last_seq,)):
+            self._tree.add(int(value, 16), (subreddit, post_id))
+            self._last_seq = seq
+
+    def _hash_thumbnail(self, url):
+        """Returns the difference hash of the image at url, None if it cannot be downloaded or decoded."""
+        try:
+            response = self.http.get(url, headers={'User-Agent': RedditCrawler.USER_AGENT})
+            if response.status != 200 or len(response.body) > NearDuplicateFilter.MAX_THUMBNAIL_BYTES:
+                self.logger.debug('Could not download thumbnail %s: HTTP %s', url, response.status)
+                return None
+            return NearDuplicateFilter.difference_hash(response.body)
+        except (http.client.HTTPException, OSError) as err:
+            self.logger.debug('Could not hash thumbnail %s: %s', url, err)
+            return None
 
     @staticmethod
-    def is_post_in_latest_posts(latest_posts, subreddit, post_id):
-        """Checks if the given value is in the given key of the given dictionary."""
-        if subreddit in latest_posts:
-            return post_id in latest_posts[subreddit]
-        return False
+    def difference_hash(data):
+        """
+        Returns the 64 bit difference hash of the encoded image: one bit per pixel of a 9x8 grayscale
+        version, set if the pixel is brighter than its right neighbour.
+        """
+        size = NearDuplicateFilter.HASH_SIZE
+        with Image.open(io.BytesIO(data)) as image:
+            image.draft('L', (size * 4, size * 4))
+            # one byte per pixel in mode L
+            pixels = image.convert('L').resize((size + 1, size), Image.LANCZOS).tobytes()
+        value = 0
+        for row in range(size):
+            for col in range(size):
+                offset = row * (size + 1) + col
+                value = (value << 1) | (pixels[offset] > pixels[offset + 1])
+        return value
+
+
+def set_telegram_api_url(url):
+    """Directs all telepot requests to the Bot API server at url instead of https://api.telegram.org."""
+    url = url.rstrip('/')
+    telepot.api._methodurl = lambda req, **user_kw: '%s/bot%s/%s' % (url, req[0], req[1])  # pylint: disable=protected-access
+    telepot.api._fileurl = lambda req: '%s/file/bot%s/%s' % (url, req[0], req[1])  # pylint: disable=protected-access
 
 
 class TelegramBot:  # pylint: disable=too-few-public-methods
     """Telegram Bot instance."""
 
-    def __init__(self, token):
+    def __init__(self, token, file_id_cache=None, rate_limiter=None, max_retries=3, admin_cache_ttl=300):
         self.bot = telepot.Bot(token)
         self.logger = Logger.get_instance()
-
-    def send_message(self, chat_id, msg, media=None, is_video=False, disable_web_page_preview=False):
-        """Sends a message to the given group."""
+        self.metrics = Metrics.get_instance()
+        self.file_ids = file_id_cache
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.admin_cache_ttl = admin_cache_ttl
+        self._admins = {}
+        self._admin_lock = threading.Lock()
+
+    def send_message(self, chat_id, msg, media=None, is_video=False, disable_web_page_preview=False,
+                     media_file=None, notify_failure=True):
+        """
+        Sends a message to the given group. The media is uploaded from media_file if it is given.
+        A failed send is reported to the group, or raised if notify_failure is False.
+        """
         try:
             if media is None:
-                self.bot.sendMessage(chat_id, msg, disable_web_page_preview=disable_web_page_preview)
-            elif is_video:
-                self.bot.sendVideo(chat_id, media, caption=msg)
+                self._call(self.bot.sendMessage, chat_id, msg, disable_web_page_preview=disable_web_page_preview)
             else:
-                self.bot.sendPhoto(chat_id, media, caption=msg)
+                with self.metrics.time('telegram_send'):
+                    self._send_media(chat_id, msg, media, is_video, media_file)
         except telepot.exception.TelegramError as te:
+            self.metrics.inc('telegram_errors_total', kind=str(te.error_code))
             self.logger.info('Caught exception ' + str(te))
-            self.bot.sendMessage(chat_id, 'Could not send picture.')
+            if not notify_failure:
+                raise
+            self._call(self.bot.sendMessage, chat_id, 'Could not send picture.')
         except socket.timeout as to:
+            self.metrics.inc('telegram_errors_total', kind='timeout')
             self.logger.info('Caught exception ' + str(to))
-            self.bot.sendMessage(chat_id, 'Could not send picture.')
+            if not notify_failure:
+                raise
+            self._call(self.bot.sendMessage, chat_id, 'Could not send picture.')
 
-    def get_updates(self, update_id=None):
-        """Returns all updates for the bot since the last update."""
+    def _call(self, method, chat_id, *args, rate_limited=True, **kwargs):
+        """
+        Calls the API method for the chat within the rate limits, retrying if Telegram asks to wait.
+        Requests sending no message pass rate_limited=False, so they do not use up the message limits.
+        """
+        for attempt in range(self.max_retries + 1):
+            if rate_limited and self.rate_limiter is not None:
+                self.rate_limiter.acquire(chat_id)
+            try:
+                return method(chat_id, *args, **kwargs)
+            except telepot.exception.TelegramError as te:
+                if te.error_code != 429 or attempt == self.max_retries:
+                    raise
+                retry_after = te.json.get('parameters', {}).get('retry_after', 1)
+                self.logger.info('Too many requests for chat %s, retrying in %s seconds', chat_id, retry_after)
+                time.sleep(retry_after)
+        return None
+
+    def _send_media(self, chat_id, msg, media, is_video, media_file=None):
+        """Sends the media, reusing the file id of an earlier upload if there is one."""
+        send = self.bot.sendVideo if is_video else self.bot.sendPhoto
+        file_id = self.file_ids.get(media) if self.file_ids is not None else None
+        if file_id is not None:
+            try:
+                self.logger.info('Reusing file id for %s', media)
+                return self._call(send, chat_id, file_id, caption=msg)
+            except telepot.exception.TelegramError as te:
+                if te.error_code == 429:
+                    raise
+                self.logger.info('File id rejected, uploading again: ' + str(te))
+                self.file_ids.discard(media)
+
+        if media_file is not None and os.path.exists(media_file):
+            message = self._call(TelegramBot._upload(send, media_file), chat_id, caption=msg)
+        else:
+            message = self._call(send, chat_id, media, caption=msg)
+        file_id = TelegramBot._get_file_id(message)
+        if self.file_ids is not None and file_id is not None:
+            self.file_ids.put(media, file_id)
+        return message
+
+    @staticmethod
+    def _upload(send, media_file):
+        """Returns a send function uploading the local file, reopened for every attempt."""
+        def send_file(chat_id, caption):
+            with open(media_file, 'rb') as handle:
+                return send(chat_id, handle, caption=caption)
+        return send_file
+
+    @staticmethod
+    def _get_file_id(message):
+        """Returns the file id of the media in a sent message, the largest size for photos."""
+        for media_type in ['video', 'animation', 'document']:
+            if media_type in message:
+                return message[media_type]['file_id']
+        if message.get('photo'):
+            return message['photo'][-1]['file_id']
+        return None
+
+    def get_updates(self, offset=None, timeout=None):
+        """Returns all updates starting at offset, waiting up to timeout seconds for new ones."""
         updates = []
         try:
-            if update_id != {}:
-                self.logger.info('Last update ID %d', update_id)
-                updates = self.bot.getUpdates(update_id)
+            if offset is not None:
+                self.logger.debug('Requesting updates from ID %d', offset)
             else:
                 self.logger.info('No update ID found, retrieving all updates')
-                updates = self.bot.getUpdates()
+            updates = self.bot.getUpdates(offset, timeout=timeout, allowed_updates=['message'])
         except socket.timeout as to:
             self.logger.info('Caught exception ' + str(to))
             self.logger.info('No updates.')
@@ -258,17 +1840,275 @@ class TelegramBot:  # pylint: disable=too-few-public-methods
         return updates
 
     def is_admin(self, chat_id, user_id):
-        """Checks if the user is admin of the specific group."""
-        status = self.bot.getChatMember(chat_id, user_id)['status']
-        return status in['creator', 'administrator']
+        """Checks if the user is admin of the specific group, asking Telegram at most once per admin_cache_ttl."""
+        key = (chat_id, user_id)
+        with self._admin_lock:
+            cached = self._admins.get(key)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+
+        status = self._call(self.bot.getChatMember, chat_id, user_id, rate_limited=False)['status']
+        is_admin = status in['creator', 'administrator']
+        with self._admin_lock:
+            self._admins[key] = (is_admin, time.monotonic() + self.admin_cache_ttl)
+        return is_admin
+
+
+class Schedule:
+    """Fire times of a trigger, given as cron expression or as lists of days, hours and minutes."""
+
+    # searching further than this many days means the schedule can never fire (e.g. 31st of February)
+    MAX_SEARCH_DAYS = 366 * 8
+
+    def __init__(self, minutes, hours, weekdays, days_of_month=None, months=None):
+        self.minutes = sorted(set(minutes))
+        self.hours = sorted(set(hours))
+        self.weekdays = set(weekdays)
+        self.days_of_month = set(days_of_month) if days_of_month is not None else None
+        self.months = set(months) if months is not None else set(range(1, 13))
+
+    @staticmethod
+    def from_trigger(trigger):
+        """Creates the schedule of a configured trigger."""
+        if 'cron' in trigger:
+            return Schedule.from_cron(trigger['cron'])
+        return Schedule(trigger['minutes'], trigger['hours'], trigger['days'])
+
+    @staticmethod
+    def from_cron(expression):
+        """
+        Parses a cron expression 'minute hour day-of-month month day-of-week'.
+        Fields support '*', lists, ranges and steps. Day of week 0 and 7 are Sunday.
+        """
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError('Cron expression needs five fields: ' + expression)
+        minutes = Schedule._parse_field(fields[0], 0, 59)
+        hours = Schedule._parse_field(fields[1], 0, 23)
+        days_of_month = Schedule._parse_field(fields[2], 1, 31)
+        months = Schedule._parse_field(fields[3], 1, 12)
+        # cron counts weekdays from sunday, python from monday
+        weekdays = {(day - 1) % 7 for day in Schedule._parse_field(fields[4], 0, 7)}
+
+        # as in cron, a restricted day of month and day of week match if either of them matches
+        if fields[2] == '*':
+            days_of_month = None
+        elif fields[4] == '*':
+            weekdays = set()
+        return Schedule(minutes, hours, weekdays, days_of_month, months)
+
+    def next_fire(self, after):
+        """Returns the first fire time strictly after the given datetime, None if there is none."""
+        start = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = start.replace(hour=0, minute=0)
+        for _ in range(Schedule.MAX_SEARCH_DAYS):
+            if self._is_day_matching(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        fire_time = day.replace(hour=hour, minute=minute)
+                        if fire_time >= start:
+                            return fire_time
+            day += timedelta(days=1)
+        return None
+
+    def _is_day_matching(self, day):
+        """Checks the month, day of month and weekday of the given day."""
+        if day.month not in self.months:
+            return False
+        if self.days_of_month is None:
+            return day.weekday() in self.weekdays
+        return day.day in self.days_of_month or day.weekday() in self.weekdays
+
+    @staticmethod
+    def _parse_field(field, minimum, maximum):
+        """Returns the values of a single cron field."""
+        values = set()
+        for part in field.split(','):
+            value_range, _, step = part.partition('/')
+            if value_range == '*':
+                first, last = minimum, maximum
+            elif '-' in value_range:
+                first, last = (int(value) for value in value_range.split('-', 1))
+            else:
+                first = last = int(value_range)
+                if step:
+                    last = maximum
+            if first < minimum or last > maximum or first > last:
+                raise ValueError('Invalid cron field: ' + field)
+            values.update(range(first, last + 1, int(step) if step else 1))
+        return values
+
+
+class TriggerScheduler:
+    """
+    Fires triggers at their exact times, sleeping until the earliest one is due.
+
+    Fires missed because a send took too long are handled by the catch up policy:
+    'all' fires every missed time, 'once' fires a single time for all missed times and
+    'skip' only fires if the delay is at most grace_period seconds.
+    """
+
+    CATCH_UP_POLICIES = ('all', 'once', 'skip')
+
+    # wake up at least this often to follow changes of the system clock
+    MAX_SLEEP = 300
+
+    def __init__(self, triggers, callback, catch_up='once', grace_period=60):
+        self.logger = Logger.get_instance()
+        self.metrics = Metrics.get_instance()
+        self.triggers = triggers
+        self.callback = callback
+        self.grace_period = grace_period
+        self._schedules = [Schedule.from_trigger(trigger) for trigger in triggers]
+        self._policies = [trigger.get('catch_up', catch_up) for trigger in triggers]
+        for policy in self._policies:
+            if policy not in TriggerScheduler.CATCH_UP_POLICIES:
+                raise ValueError('Unknown catch up policy: ' + str(policy))
+        self._heap = []
+
+    def run(self, stop):
+        """Fires the triggers until the stop event is set."""
+        now = datetime.now()
+        self._heap = []
+        for idx in range(len(self.triggers)):
+            self._schedule(idx, now)
+
+        while not stop.is_set():
+            now = datetime.now()
+            if not self._heap:
+                stop.wait(TriggerScheduler.MAX_SLEEP)
+                continue
+            fire_time, idx = self._heap[0]
+            if fire_time > now:
+                stop.wait(min((fire_time - now).total_seconds(), TriggerScheduler.MAX_SLEEP))
+                continue
+
+            heapq.heappop(self._heap)
+            policy = self._policies[idx]
+            delay = (now - fire_time).total_seconds()
+            self.metrics.observe('trigger_lag_seconds', delay)
+            if policy == 'skip' and delay > self.grace_period:
+                self.logger.info('Skipping trigger %s, it is %.0f seconds late', idx, delay)
+            else:
+                self.logger.info('Firing trigger %s scheduled for %s', idx, fire_time)
+                self.callback(self.triggers[idx])
+            # 'all' continues right after the fired time and thereby fires every missed time
+            self._schedule(idx, fire_time if policy == 'all' else max(now, fire_time))
+
+    def get_next_fire_times(self):
+        """Returns the pending fire times with their trigger index, earliest first."""
+        return sorted(self._heap)
+
+    def _schedule(self, idx, after):
+        """Pushes the next fire time of the trigger after the given time onto the heap."""
+        fire_time = self._schedules[idx].next_fire(after)
+        if fire_time is None:
+            self.logger.info('Trigger %s will never fire', idx)
+        else:
+            heapq.heappush(self._heap, (fire_time, idx))
+
+
+class UpdateConsumer:
+    """Long polls the Telegram updates, keeping the offset in memory and checkpointing it in batches."""
+
+    def __init__(self, telegram_bot, nvm_handler, timeout=25, checkpoint_interval=50,
+                 filename='update_id.pickle', state=None):
+        self.logger = Logger.get_instance()
+        self.metrics = Metrics.get_instance()
+        self.telegram_bot = telegram_bot
+        self.nvm = nvm_handler
+        self.timeout = timeout
+        self.checkpoint_interval = checkpoint_interval
+        self.filename = filename
+        # optional SharedState keeping the offset instead of the pickle file
+        self.state = state
+        self.resume()
+
+    def resume(self):
+        """Continues after the last stored update id, e.g. after another process consumed updates."""
+        if self.state is not None:
+            self.last_update_id = self.state.get('update_id')
+        else:
+            # the id of the last consumed update, NvMHandler returns {} if nothing was stored yet
+            stored = self.nvm.load(self.filename)
+            self.last_update_id = stored if stored != {} else None
+        self._unsaved = 0
+
+    def poll(self, timeout=None):
+        """Waits up to timeout (default the configured) seconds and returns the updates following the last consumed one."""
+        offset = self.last_update_id + 1 if self.last_update_id is not None else None
+        updates = self.telegram_bot.get_updates(offset, self.timeout if timeout is None else timeout)
+        self.metrics.inc('updates_total', len(updates))
+        if updates:
+            self.last_update_id = updates[-1]['update_id']
+            self._unsaved += len(updates)
+            if self._unsaved >= self.checkpoint_interval:
+                self.checkpoint()
+        return updates
+
+    def checkpoint(self):
+        """Stores the id of the last consumed update if it changed since the last checkpoint."""
+        if self._unsaved:
+            if self.state is not None:
+                self.state.set('update_id', self.last_update_id)
+            else:
+                self.nvm.store(self.last_update_id, self.filename)
+            self._unsaved = 0
+
+
+class CommandRegistry:
+    """The commands of the bot, looked up case insensitive by name."""
+
+    def __init__(self):
+        self._commands = {}
+
+    def register(self, name, function, requires_admin=False):
+        """Registers the callable function(parameter, test, chat) as command name."""
+        self._commands[name.lower()] = {'command_string': name,
+                                        'command_function': function,
+                                        'command_requires_admin': requires_admin}
+
+    def get(self, name):
+        """Returns the command with the given name, None if there is none."""
+        return self._commands.get(name.lower()) if name else None
 
 
 class Configuration:
     """Configuration for the picturebot."""
 
     def __init__(self, config_file='config.json'):
-        self.cfg = {}
+        self.logger = Logger.get_instance()
+        self.config_file = config_file
+        self._mtime = os.stat(config_file).st_mtime_ns
         self.cfg = Configuration.get_config(config_file)
+        self._title_filters = Configuration._compile_title_filters(self.cfg)
+        self._chats, self._chats_by_id, self._chats_by_test_id = Configuration._build_chats(self.cfg)
+
+    def reload(self):
+        """
+        Reads the config file again if it was modified since it was read.
+        Returns the set of top level keys whose values changed, an invalid file is ignored entirely.
+        """
+        try:
+            mtime = os.stat(self.config_file).st_mtime_ns
+            if mtime == self._mtime:
+                return set()
+            cfg = Configuration.get_config(self.config_file)
+            changed = {key for key in set(self.cfg) | set(cfg) if self.cfg.get(key) != cfg.get(key)}
+            if changed:
+                title_filters = Configuration._compile_title_filters(cfg)
+                chats = Configuration._build_chats(cfg)
+        except (OSError, ValueError, re.error, KeyError, TypeError, AttributeError) as err:
+            self.logger.error('Could not reload %s: %s', self.config_file, err)
+            return set()
+
+        self._mtime = mtime
+        if changed:
+            self.logger.info('Reloaded %s, changed: %s', self.config_file, ', '.join(sorted(changed)))
+            self.cfg = cfg
+            self._title_filters = title_filters
+            self._chats, self._chats_by_id, self._chats_by_test_id = chats
+        return changed
 
     def get_subreddits(self):
         """Returns the subreddits from the config file."""
@@ -278,10 +2118,192 @@ class Configuration:
         """Returns the chat id from the config file."""
         return self.cfg.get('test_group_id', 0) if test else self.cfg.get('group_id', 0)
 
+    def get_chats(self):
+        """
+        Returns the chats the bot sends to, each with its group ids, subreddits and triggers.
+        Without a list of chats, the top level group ids, subreddits and triggers form the only chat.
+        Settings missing in a chat are taken from the top level.
+        """
+        return self._chats
+
+    def get_chat(self, chat_id, test=False):
+        """Returns the configured chat with the given (test) group id, None if there is none."""
+        return self._chats_by_test_id.get(chat_id) if test else self._chats_by_id.get(chat_id)
+
+    @staticmethod
+    def _build_chats(cfg):
+        """Returns the chats of the config and their lookup tables by group id and test group id."""
+        chats = [{'group_id': chat.get('group_id', 0),
+                  'test_group_id': chat.get('test_group_id', cfg.get('test_group_id', 0)),
+                  'subreddits': chat.get('subreddits', cfg.get('subreddits', [])),
+                  'triggers': chat.get('triggers', cfg.get('triggers', None) or [])}
+                 for chat in cfg.get('chats', [{'group_id': cfg.get('group_id', 0)}])]
+        chats_by_id = {}
+        chats_by_test_id = {}
+        for chat in chats:
+            chats_by_id.setdefault(chat['group_id'], chat)
+            # several chats may share a test group, commands there act on the first one
+            chats_by_test_id.setdefault(chat['test_group_id'], chat)
+        return chats, chats_by_id, chats_by_test_id
+
+    def get_all_subreddits(self):
+        """Returns the subreddits of all chats without duplicates."""
+        subreddits = []
+        for chat in self.get_chats():
+            subreddits.extend(sub for sub in chat['subreddits'] if sub not in subreddits)
+        return subreddits
+
+    def get_chat_triggers(self):
+        """Returns the triggers of all chats, each extended by the group id of its chat."""
+        return [dict(trigger, group_id=chat['group_id'])
+                for chat in self.get_chats() for trigger in chat['triggers']]
+
+    def get_command_settings(self):
+        """Returns the number of commands processed in parallel and how long admin states are cached."""
+        return {'workers': self.cfg.get('command_workers', 4),
+                'admin_cache_ttl': self.cfg.get('admin_cache_ttl', 300)}
+
+    def get_send_settings(self):
+        """Returns the number of parallel sends and the Telegram rate limits."""
+        return {'workers': self.cfg.get('send_workers', 4),
+                'global_rate': self.cfg.get('telegram_global_rate', 30),
+                'group_rate': self.cfg.get('telegram_group_rate', 20),
+                'private_rate': self.cfg.get('telegram_private_rate', 1)}
+
+    def get_listing_cache_ttl(self):
+        """Returns the number of seconds a fetched subreddit listing is reused."""
+        return self.cfg.get('listing_cache_ttl', 60)
+
+    def get_listing_cache_size(self):
+        """Returns the maximum number of cached listing pages."""
+        return self.cfg.get('listing_cache_size', 500)
+
+    def get_listing_settings(self):
+        """
+        Returns the reddit server, the number of posts per fetched page, the maximum number of pages searched
+        and how often a failed request is retried.
+        """
+        return {'page_size': self.cfg.get('listing_page_size', 25),
+                'max_pages': self.cfg.get('listing_max_pages', 3),
+                'base_url': self.cfg.get('reddit_url', 'https://www.reddit.com'),
+                'max_retries': self.cfg.get('reddit_max_retries', 3)}
+
+    def get_telegram_api_url(self):
+        """Returns the URL of the Telegram Bot API server."""
+        return self.cfg.get('telegram_api_url', 'https://api.telegram.org')
+
+    def get_http_settings(self):
+        """Returns the pool size and timeouts used for the reddit connections."""
+        return {'pool_size': self.cfg.get('http_pool_size', 4),
+                'connect_timeout': self.cfg.get('http_connect_timeout', 5),
+                'read_timeout': self.cfg.get('http_read_timeout', 30)}
+
+    def get_media_cache_settings(self):
+        """Returns the directory and byte budget of the media cache, None if media is passed by URL."""
+        if not self.cfg.get('media_cache_enabled', False):
+            return None
+        return {'directory': self.cfg.get('media_cache_dir', 'media_cache'),
+                'max_bytes': self.cfg.get('media_cache_max_mb', 500) * 1024 * 1024}
+
+    def get_reddit_rate_settings(self):
+        """
+        Returns the requests per second and burst allowed towards reddit, and the maximum backoff in seconds
+        after throttling or server errors.
+        """
+        return {'rate': self.cfg.get('reddit_rate', 1),
+                'capacity': self.cfg.get('reddit_burst', 5),
+                'max_delay': self.cfg.get('reddit_max_backoff', 60)}
+
+    def get_selector_settings(self):
+        """
+        Returns the cooldown in seconds of subreddits which delivered no post max_misses times in a row,
+        and the share of uniformly random subreddit picks.
+        """
+        return {'cooldown': self.cfg.get('subreddit_cooldown', 600),
+                'max_misses': self.cfg.get('subreddit_max_misses', 3),
+                'exploration': self.cfg.get('subreddit_exploration', 0.1)}
+
+    def get_near_duplicate_settings(self):
+        """
+        Returns the Hamming distance threshold, the number of remembered hashes and the hash worker count
+        of the near duplicate detection, None if it is disabled.
+        """
+        if not self.cfg.get('near_duplicates_enabled', False):
+            return None
+        return {'filename': self.cfg.get('history_file', 'posts.db'),
+                'threshold': self.cfg.get('near_duplicates_threshold', 6),
+                'depth': self.cfg.get('near_duplicates_depth', 10000),
+                'workers': self.cfg.get('near_duplicates_workers', 4)}
+
+    def get_metrics_settings(self):
+        """Returns the HTTP host and port and the file the metrics are exported to, None if metrics are disabled."""
+        port = self.cfg.get('metrics_port', 0)
+        filename = self.cfg.get('metrics_file', '')
+        if not port and not filename:
+            return None
+        return {'port': port,
+                'host': self.cfg.get('metrics_host', '127.0.0.1'),
+                'filename': filename,
+                'flush_interval': self.cfg.get('metrics_flush_interval', 60)}
+
+    def get_file_id_cache_size(self):
+        """Returns the number of remembered Telegram file ids of uploaded media."""
+        return self.cfg.get('file_id_cache_size', 1000)
+
+    def get_cluster_settings(self):
+        """Returns the seconds the leader of the worker processes holds its lease without renewing it."""
+        return {'lease_ttl': self.cfg.get('leader_lease_ttl', 30)}
+
+    def get_supervisor_settings(self):
+        """
+        Returns the seconds between checks of the config file for changes and the minimum and maximum
+        delay before a failed component is restarted.
+        """
+        return {'reload_interval': self.cfg.get('config_reload_interval', 30),
+                'min_backoff': self.cfg.get('restart_min_backoff', 1),
+                'max_backoff': self.cfg.get('restart_max_backoff', 300)}
+
+    def get_scheduler_settings(self):
+        """Returns the default catch up policy of missed trigger times and the grace period in seconds."""
+        return {'catch_up': self.cfg.get('trigger_catch_up', 'once'),
+                'grace_period': self.cfg.get('trigger_grace_period', 60)}
+
+    def get_update_settings(self):
+        """Returns the long polling timeout and the number of updates between offset checkpoints."""
+        return {'timeout': self.cfg.get('long_poll_timeout', 25),
+                'checkpoint_interval': self.cfg.get('update_checkpoint_interval', 50)}
+
+    def get_history_settings(self):
+        """Returns the database file and the number of remembered posts per subreddit."""
+        return {'filename': self.cfg.get('history_file', 'posts.db'),
+                'depth': self.cfg.get('history_depth', 1000)}
+
+    def get_prefetch_settings(self):
+        """Returns the queue size, refresh interval and worker count of the prefetcher."""
+        return {'queue_size': self.cfg.get('prefetch_queue_size', 3),
+                'interval': self.cfg.get('prefetch_interval', 120),
+                'workers': self.cfg.get('prefetch_workers', 4)}
+
     def get_filter_regex(self):
         """Returns the filtering regex from the config file."""
         return self.cfg.get('filter_regex', '.*')
 
+    def get_title_filters(self):
+        """Returns the precompiled title filters per subreddit."""
+        return self._title_filters
+
+    def get_title_filter(self, subreddit):
+        """Returns the precompiled title filter of the subreddit, None if its titles are not filtered."""
+        return self._title_filters.get(subreddit, self._title_filters.get(None))
+
+    @staticmethod
+    def _compile_title_filters(cfg):
+        """Compiles the filter regexes of the config once. A plain string applies to all subreddits."""
+        filter_regex = cfg.get('filter_regex', '.*')
+        if not isinstance(filter_regex, dict):
+            return {None: TitleFilter.from_config(filter_regex)}
+        return {subreddit: TitleFilter.from_config(value) for subreddit, value in filter_regex.items()}
+
     def get_bot_token(self):
         """Returns the Telegram bot token from the config file."""
         return self.cfg.get('bot_token', '')
@@ -313,78 +2335,409 @@ class Configuration:
 class Picturebot:
     """"Provides functionality to send pictures to telegram groups"""
 
-    def __init__(self, config_file='config.json'):
+    def __init__(self, config_file='config.json', worker=None):
         # Setup configuration
         self._cfg = Configuration(config_file)
+        # index and count of the worker processes, None if the bot runs in a single process
+        self._worker = worker
+        # Setup metrics, collected only if an export is configured
+        self._metrics = Metrics.get_instance()
+        metrics_settings = self._cfg.get_metrics_settings()
+        if metrics_settings is not None:
+            if worker is not None:
+                # every worker process exports its own metrics
+                metrics_settings['port'] = metrics_settings['port'] + worker[0] if metrics_settings['port'] else None
+                metrics_settings['filename'] = ('%s.%d' % (metrics_settings['filename'], worker[0])
+                                                if metrics_settings['filename'] else None)
+            self._metrics.enable(**metrics_settings)
         # Setup crawler to retrieve reddit posts
-        self._crawler = RedditCrawler()
+        self._http_client = HttpClient(**self._cfg.get_http_settings())
+        history_settings = self._cfg.get_history_settings()
+        self._history = HistoryStore(shared=worker is not None, **history_settings)
+        # Setup state shared by the worker processes
+        self._state = SharedState(history_settings['filename']) if worker is not None else None
+        self._leading = False
+        self._near_duplicates = None
+        near_duplicate_settings = self._cfg.get_near_duplicate_settings()
+        if near_duplicate_settings is not None:
+            if Image is None:
+                Logger.get_instance().error('Near duplicate detection needs Pillow, it is disabled')
+            else:
+                self._near_duplicates = NearDuplicateFilter(self._http_client, **near_duplicate_settings)
+        self._crawler = RedditCrawler(self._cfg.get_listing_cache_ttl(), self._http_client, self._history,
+                                      cache_size=self._cfg.get_listing_cache_size(),
+                                      near_duplicates=self._near_duplicates,
+                                      rate_limiter=RedditRateLimiter(**self._cfg.get_reddit_rate_settings()),
+                                      **self._cfg.get_listing_settings())
+        # Setup selector of the subreddits, learning from the searched pages
+        self._selector = SubredditSelector(**self._cfg.get_selector_settings())
+        self._crawler.add_candidate_listener(self._selector.record_candidates)
+        # Setup NvM Handler
+        self._nvm_handler = NvMHandler()
         # Setup bot to post to telegram
-        self._telegram_bot = TelegramBot(self._cfg.get_bot_token())
+        set_telegram_api_url(self._cfg.get_telegram_api_url())
+        send_settings = self._cfg.get_send_settings()
+        command_settings = self._cfg.get_command_settings()
+        self._file_ids = FileIdCache(history_settings['filename'], self._cfg.get_file_id_cache_size())
+        self._telegram_bot = TelegramBot(self._cfg.get_bot_token(),
+                                         self._file_ids,
+                                         TelegramRateLimiter(send_settings['global_rate'],
+                                                             send_settings['group_rate'],
+                                                             send_settings['private_rate']),
+                                         admin_cache_ttl=command_settings['admin_cache_ttl'])
+        # Setup worker pool for sending to several chats at once
+        self._send_pool = concurrent.futures.ThreadPoolExecutor(max_workers=send_settings['workers'],
+                                                                thread_name_prefix='send')
         # Setup logger
         self._logger = Logger.get_instance()
-        # Setup NvM Handler
-        self._nvm_handler = NvMHandler()
-        # Setup command dictionary
-        self._commands = \
-            [
-                {'command_string': 'MakeMeHappy',
-                 'command_function': self._make_me_happy,
-                 'command_requires_admin': False},
-                {'command_string': 'source',
-                 'command_function': self._get_source,
-                 'command_requires_admin': False}
-            ]
-        self.last_post_id = None
-
-    def send_picture(self, sub_reddit=None, test=False):
+        # Setup optional download stage for media
+        media_cache_settings = self._cfg.get_media_cache_settings()
+        self._media_cache = None
+        if media_cache_settings is not None:
+            self._media_cache = MediaCache(self._http_client, self._nvm_handler, **media_cache_settings)
+        # Setup consumer of the telegram updates
+        self._update_consumer = UpdateConsumer(self._telegram_bot, self._nvm_handler, state=self._state,
+                                               **self._cfg.get_update_settings())
+        # Setup command registry
+        self._commands = CommandRegistry()
+        self._commands.register('MakeMeHappy', self._make_me_happy)
+        self._commands.register('source', self._get_source)
+        # Setup worker pool for commands, at most four pending commands per worker
+        self._command_pool = concurrent.futures.ThreadPoolExecutor(max_workers=command_settings['workers'],
+                                                                   thread_name_prefix='command')
+        self._command_slots = threading.BoundedSemaphore(command_settings['workers'] * 4)
+        # commands being processed, mapped to the identical request received meanwhile
+        self._running_commands = {}
+        self._running_commands_lock = threading.Lock()
+        self._last_post_ids = {}
+        # Setup prefetcher providing ready-to-send posts, started by start_prefetching()
+        self._prefetcher = None
+
+    def send_picture(self, sub_reddit=None, test=False, chat=None):
         """
         Pics a picture from the given subreddit and sends it to the telegram group.
-        If no subreddit it given, a random one from the config is selected.
+        If no subreddit it given, one from the config of the chat is selected by the subreddit selector.
 
         Keyword arguments:
         sub_reddit -- the subreddit if it shall be set fix (default None)
         test -- flag indicating if the message shall be sent to the testgroup
+        chat -- the configured chat to send to (default the first one)
         """
-        # if no subreddit is predefined --> get random subreddit from list
+        if chat is None:
+            chat = self._cfg.get_chats()[0]
+
+        # if no subreddit is predefined --> pick one of the chat, preferring those delivering posts
         if sub_reddit is None:
-            sub_reddit = random.choice(self._cfg.get_subreddits())
+            sub_reddit = self._selector.select(chat['subreddits'])
 
         # select group id the message is sent to based on test flag
-        chat_id = self._cfg.get_chat_id(test)
-
-        # get images from selected subreddit
-        reddit_data = self._crawler.get_subreddit_posts_from_api(sub_reddit)
+        chat_id = chat['test_group_id'] if test else chat['group_id']
+
+        with self._metrics.time('send_picture'):
+            # take an already prefetched post if one is ready
+            post = self._prefetcher.pop(sub_reddit) if self._prefetcher is not None else None
+            if post is not None and self._crawler.mark_post_sent(post):
+                self._send_post(chat_id, post)
+                self._metrics.inc('sends_total', result='prefetched')
+                self._selector.record_send(sub_reddit, True)
+                return
+
+            # get images from selected subreddit
+            start = time.monotonic()
+            try:
+                listing = self._crawler.get_subreddit_posts_from_api(sub_reddit)
+            except SubredditNotFoundError:
+                self._selector.record_send(sub_reddit, False)
+                self._metrics.inc('sends_total', result='not_found')
+                self._logger.info('Subreddit not found: ' + str(sub_reddit))
+                self._telegram_bot.send_message(chat_id, 'Check your subreddit.')
+                return
+            except RedditThrottledError:
+                self._metrics.inc('sends_total', result='throttled')
+                self._logger.info('Reddit throttled the request for subreddit: ' + str(sub_reddit))
+                self._telegram_bot.send_message(chat_id, 'Reddit is busy right now, try again later.')
+                return
+            except RedditError as err:
+                self._metrics.inc('sends_total', result='fetch_error')
+                self._logger.info('Error retrieving data for subreddit %s: %s', sub_reddit, err)
+                self._telegram_bot.send_message(chat_id, 'Could not reach reddit, try again later.')
+                return
 
-        # check received reddit_data
-        if reddit_data is not None:
             # select image and construct post
-            post = self._crawler.get_post(reddit_data, sub_reddit, self._cfg.get_filter_regex())
+            post = self._crawler.get_post(listing, self._cfg.get_title_filter(sub_reddit), self._prepare_media)
+            self._selector.record_send(sub_reddit, post is not None, time.monotonic() - start)
 
             if post:
                 # if an appropriate post was found then send it
-                msg = post['sub_reddit'] + ': ' + post['title']
-                self._telegram_bot.send_message(chat_id, msg, media=post['media_url'], is_video=post['is_video'])
-                self.last_post_id = post['post_id']
+                self._send_post(chat_id, post)
+                self._metrics.inc('sends_total', result='fetched')
             else:
                 # if no appropriate post was found then send information
+                self._metrics.inc('sends_total', result='no_post')
                 self._telegram_bot.send_message(chat_id, 'Did not find an adequate post. Tired of searching...')
-        else:
-            self._logger.info('Error retrieving data for subreddit: ' + str(sub_reddit))
-            self._telegram_bot.send_message(chat_id, 'Check your subreddit.')
 
-    def get_source(self, parameter, test=False):
+    def send_batch(self, subreddits, count, test=False, chat=None):
+        """
+        Sends count posts taken in turns from the given subreddits to the telegram group, e.g. to catch up
+        after an outage or to seed a new group. The listings are fetched concurrently, the posts are claimed
+        in one history transaction and downloaded and sent by the send workers.
+        Returns the numbers of sent, skipped and failed posts and the elapsed seconds.
+        """
+        if chat is None:
+            chat = self._cfg.get_chats()[0]
+        chat_id = chat['test_group_id'] if test else chat['group_id']
+        start = time.monotonic()
+
+        def collect(subreddit):
+            try:
+                listing = self._crawler.get_subreddit_posts_from_api(subreddit)
+            except RedditError as err:
+                self._logger.info('Skipping subreddit %s: %s', subreddit, err)
+                return []
+            return list(itertools.islice(self._crawler.iter_candidates(listing, self._cfg.get_title_filter(subreddit)),
+                                         count))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(subreddits), 8) or 1,
+                                                   thread_name_prefix='batch') as executor:
+            candidates = list(executor.map(collect, subreddits))
+        # take the newest posts of all subreddits in turns
+        ordered = [post for posts in itertools.zip_longest(*candidates) for post in posts if post is not None]
+        candidate_count = len(ordered)
+        posts = []
+        while len(posts) < count and ordered:
+            # other processes may claim some of the posts meanwhile, they are replaced by the following ones
+            claim, ordered = ordered[:count - len(posts)], ordered[count - len(posts):]
+            posts.extend(self._crawler.mark_posts_sent(claim))
+        self._logger.info('Batch of %s posts from %s candidates', len(posts), candidate_count)
+
+        def send(post):
+            if not self._prepare_media(post):
+                return 'skipped'
+            # failures are counted in the report instead of being posted to the group one by one
+            self._send_post(chat_id, post, notify_failure=False)
+            return 'sent'
+
+        results = collections.Counter()
+        for future in [self._send_pool.submit(send, post) for post in posts]:
+            try:
+                results[future.result()] += 1
+            except Exception as err:  # pylint: disable=broad-except
+                self._logger.error('Sending batch post failed: %s', err)
+                results['failed'] += 1
+        self._metrics.inc('sends_total', results['sent'], result='batch')
+
+        report = {'sent': results['sent'], 'skipped': results['skipped'], 'failed': results['failed'],
+                  'seconds': time.monotonic() - start}
+        self._logger.info('Sent %s posts in %.1f seconds (%.2f posts/s), %s skipped, %s failed',
+                          report['sent'], report['seconds'], report['sent'] / max(report['seconds'], 1e-9),
+                          report['skipped'], report['failed'])
+        return report
+
+    def _send_post(self, chat_id, post, notify_failure=True):
+        """
+        Sends the media of the given post to the chat and remembers it as the last post.
+        A failed send is reported to the chat, or raised if notify_failure is False.
+        """
+        msg = post.sub_reddit + ': ' + post.title
+        self._telegram_bot.send_message(chat_id, msg, media=post.media_url, is_video=post.is_video,
+                                        media_file=post.media_file, notify_failure=notify_failure)
+        self._last_post_ids[chat_id] = post.post_id
+
+    def _prepare_media(self, post):
+        """Downloads the media of the post into the media cache. Returns False if it is too large to be sent."""
+        if self._media_cache is None:
+            return True
+        try:
+            post.media_file = self._media_cache.fetch(post.media_url, post.is_video)
+        except MediaTooLargeError as err:
+            self._logger.info('Skipping post %s: %s', post.post_id, err)
+            return False
+        return True
+
+    def submit_picture(self, sub_reddit=None, test=False, chat=None):
+        """Sends a picture like send_picture on the worker pool and returns the future."""
+        future = self._send_pool.submit(self.send_picture, sub_reddit, test, chat)
+        future.add_done_callback(self._log_send_failure)
+        return future
+
+    def _log_send_failure(self, future):
+        """Logs the exception of a failed send of the worker pool."""
+        if not future.cancelled() and future.exception() is not None:
+            self._logger.error('Sending picture failed: %s', future.exception())
+
+    def get_chat(self, chat_id, test=False):
+        """Returns the configured chat with the given (test) group id."""
+        return self._cfg.get_chat(chat_id, test)
+
+    def get_chats(self):
+        """Returns the configured chats."""
+        return self._cfg.get_chats()
+
+    def start_prefetching(self):
+        """Starts refilling the post queues of the subreddits of all chats of this worker in the background."""
+        settings = self._cfg.get_prefetch_settings()
+        if self._prefetcher is None and settings['interval'] > 0:
+            subreddits = sorted({sub for chat in self._cfg.get_chats() if self.owns_group(chat['group_id'])
+                                 for sub in chat['subreddits']})
+            self._prefetcher = Prefetcher(self._crawler,
+                                          subreddits,
+                                          {sub: self._cfg.get_title_filter(sub) for sub in subreddits},
+                                          prepare=self._prepare_media,
+                                          **settings)
+            self._prefetcher.start()
+
+    # config keys whose changes are applied by reload_config, all others take effect after a restart
+    PREFETCH_KEYS = frozenset(['subreddits', 'chats', 'filter_regex', 'prefetch_queue_size',
+                               'prefetch_interval', 'prefetch_workers'])
+    TRIGGER_KEYS = frozenset(['triggers', 'chats', 'group_id', 'trigger_catch_up', 'trigger_grace_period'])
+    LIVE_KEYS = frozenset(['test_group_id', 'activation_prefix', 'godfather_command', 'admin_id',
+                           'subreddit_cooldown', 'subreddit_max_misses', 'subreddit_exploration',
+                           'listing_cache_ttl', 'listing_page_size', 'listing_max_pages', 'reddit_url',
+                           'reddit_max_retries', 'reddit_rate', 'reddit_burst', 'reddit_max_backoff',
+                           'telegram_global_rate', 'telegram_group_rate', 'telegram_private_rate',
+                           'admin_cache_ttl', 'long_poll_timeout', 'update_checkpoint_interval',
+                           'config_reload_interval', 'restart_min_backoff', 'restart_max_backoff'])
+
+    def reload_config(self):
+        """
+        Reloads the config file if it changed and applies the changed settings to the running components.
+        Returns the set of changed keys.
+        """
+        changed = self._cfg.reload()
+        if not changed:
+            return changed
+
+        selector_settings = self._cfg.get_selector_settings()
+        self._selector.cooldown = selector_settings['cooldown']
+        self._selector.max_misses = selector_settings['max_misses']
+        self._selector.exploration = selector_settings['exploration']
+
+        listing_settings = self._cfg.get_listing_settings()
+        self._crawler.cache.ttl = self._cfg.get_listing_cache_ttl()
+        self._crawler.page_size = listing_settings['page_size']
+        self._crawler.max_pages = listing_settings['max_pages']
+        self._crawler.max_retries = listing_settings['max_retries']
+        self._crawler.base_url = listing_settings['base_url'].rstrip('/')
+        if changed & {'reddit_rate', 'reddit_burst', 'reddit_max_backoff'}:
+            self._crawler.rate_limiter = RedditRateLimiter(**self._cfg.get_reddit_rate_settings())
+
+        send_settings = self._cfg.get_send_settings()
+        if changed & {'telegram_global_rate', 'telegram_group_rate', 'telegram_private_rate'}:
+            self._telegram_bot.rate_limiter = TelegramRateLimiter(send_settings['global_rate'],
+                                                                  send_settings['group_rate'],
+                                                                  send_settings['private_rate'])
+        self._telegram_bot.admin_cache_ttl = self._cfg.get_command_settings()['admin_cache_ttl']
+        update_settings = self._cfg.get_update_settings()
+        self._update_consumer.timeout = update_settings['timeout']
+        self._update_consumer.checkpoint_interval = update_settings['checkpoint_interval']
+
+        if self._prefetcher is not None and changed & Picturebot.PREFETCH_KEYS:
+            self._prefetcher.stop()
+            self._prefetcher = None
+            self.start_prefetching()
+
+        restart_keys = changed - Picturebot.PREFETCH_KEYS - Picturebot.TRIGGER_KEYS - Picturebot.LIVE_KEYS
+        if restart_keys:
+            self._logger.info('Changes of %s take effect after a restart', ', '.join(sorted(restart_keys)))
+        return changed
+
+    def get_triggers(self):
+        """Returns the triggers of all configured chats of this worker."""
+        return [trigger for trigger in self._cfg.get_chat_triggers() if self.owns_group(trigger['group_id'])]
+
+    def get_owner(self, group_id):
+        """Returns the index of the worker process sending to the group."""
+        return group_id % self._worker[1] if self._worker is not None else 0
+
+    def owns_group(self, group_id):
+        """Checks if this process sends to the group."""
+        return self._worker is None or self.get_owner(group_id) == self._worker[0]
+
+    def get_cluster_settings(self):
+        """Returns the lease duration of the leader polling the updates."""
+        return self._cfg.get_cluster_settings()
+
+    def lead_updates(self, owner, lease_ttl):
         """
-        Provides the link of the last sent picture.
+        Polls the updates if owner holds or takes over the leader lease of the worker processes.
+        Returns None if another process is the leader. The updates are consumed, see checkpoint_updates.
         """
+        if not self._state.acquire_lease('updates', owner, lease_ttl):
+            self._leading = False
+            return None
+        if not self._leading:
+            self._logger.info('%s became leader', owner)
+            # the former leader may have consumed updates
+            self._update_consumer.resume()
+            self._leading = True
+        # a poll must end well before the lease expires
+        return self._update_consumer.poll(min(self._update_consumer.timeout, lease_ttl / 3))
+
+    def checkpoint_updates(self):
+        """Stores the offset of the consumed updates."""
+        self._update_consumer.checkpoint()
+
+    def resign(self, owner):
+        """Gives up the leader lease. Updates consumed since the last checkpoint are polled again by the next leader."""
+        if self._leading:
+            self._state.release_lease('updates', owner)
+            self._leading = False
+
+    def get_scheduler_settings(self):
+        """Returns the catch up policy and the grace period of the trigger scheduler."""
+        return self._cfg.get_scheduler_settings()
+
+    def get_supervisor_settings(self):
+        """Returns the config reload interval and the restart backoff of the supervisor."""
+        return self._cfg.get_supervisor_settings()
+
+    def report_failure(self, component):
+        """Writes the current exception to trace.log and sends it to the admin."""
+        trace = traceback.format_exc()
+        with open('trace.log', 'w') as file_handle:
+            file_handle.write(str(datetime.now()))
+            file_handle.write('\n')
+            file_handle.write(trace)
+            file_handle.write('\n')
+        admin_id = self._cfg.get_admin_id()
+        if admin_id is not None:
+            try:
+                self._telegram_bot.send_message(admin_id, 'Error occured in %s, restarting it.\n%s'
+                                                % (component, trace))
+            except Exception as err:  # pylint: disable=broad-except
+                self._logger.error('Could not inform admin: %s', err)
+
+    def close(self):
+        """Stops the prefetcher, checkpoints the update offset and releases connections and history."""
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+        self._command_pool.shutdown(wait=True)
+        self._send_pool.shutdown(wait=True)
+        self._update_consumer.checkpoint()
+        if self._near_duplicates is not None:
+            self._near_duplicates.close()
+        self._http_client.close()
+        self._file_ids.close()
+        self._history.close()
+        if self._state is not None:
+            self._state.close()
+
+    def get_source(self, parameter, test=False, chat=None):
+        """
+        Provides the link of the last sent picture of the chat.
+        """
+        if chat is None:
+            chat = self._cfg.get_chats()[0]
 
         # select group id the message is sent to based on test flag
-        chat_id = self._cfg.get_chat_id(test)
+        chat_id = chat['test_group_id'] if test else chat['group_id']
 
         # check if information about last sent post is available
-        if self.last_post_id is None:
+        last_post_id = self._last_post_ids.get(chat_id)
+        if last_post_id is None:
             self._telegram_bot.send_message(chat_id, 'No info about last post stored.')
         else:
-            self._telegram_bot.send_message(chat_id, 'https://www.reddit.com/' + str(self.last_post_id), disable_web_page_preview=True)
+            self._telegram_bot.send_message(chat_id, 'https://www.reddit.com/' + str(last_post_id), disable_web_page_preview=True)
 
     def process_commands(self, test=False):
         """
@@ -394,75 +2747,138 @@ class Picturebot:
         test -- flag indicating if the function shall operate
                 on the testgroup
         """
-        # load last update id from NvM
-        last_update_id = self._nvm_handler.load('update_id.pickle')
-
-        # get updates after the loaded update id
-        updates = self._telegram_bot.get_updates(last_update_id)
-
-        # if there are updates store the latest update id
-        if len(updates) > 1:
-            # discard the first update as it is the one with the provided update id
-            updates = updates[1:]
-            self._nvm_handler.store(updates[-1]['update_id'], 'update_id.pickle')
-        else:
+        # wait for updates after the last consumed one
+        updates = self._update_consumer.poll()
+        if not updates:
             self._logger.info('No new messages in chat')
             return
+        self.handle_updates(updates, test)
 
-        chat_id = self._cfg.get_chat_id(test)
+    def handle_updates(self, updates, test=False):
+        """Processes the commands of the given updates."""
+        # config values needed for every update
+        prefix = self._cfg.get_activation_prefix()
+        botfather_command = self._cfg.get_botfather_generated_command()
 
-        # process all updates
+        # collect the commands of all updates, identical requests are only processed once
+        requests = collections.OrderedDict()
         for update in updates:
-            # check if message was sent in configured group
-            if update['message']['chat']['type'] in ['supergroup', 'group'] and update['message']['chat']['id'] == chat_id:
-                # check if message was for bot
-                if update['message']['text'].startswith(self._cfg.get_activation_prefix()):
-                    # check if command is implemented
-                    command_split = update['message']['text'].split(' ')
-
-                    # work around for auto-generated picbot command
-                    if len(command_split) == 1 and command_split[0] == self._cfg.get_botfather_generated_command():
-                        command_name = 'MakeMeHappy'
-                    elif len(command_split) > 1:
-                        command_name = command_split[1]
-
-                    command_param = None
-                    if len(command_split) == 3:
-                        command_param = update['message']['text'].split(' ')[2]
-                    if command_name is not None:
-                        command = next((command for command in self._commands
-                                        if command['command_string'].lower() == command_name.lower()), None)
-                    else:
-                        command = None
-                    if command:
-                        # check if admin privileges are needed
-                        command_permissions = False
-                        if command['command_requires_admin'] is True:
-                            # check if sender is admin
-                            command_permissions = self._telegram_bot.is_admin(
-                                update['message']['chat']['id'],
-                                update['message']['from']['id'])
-                        else:
-                            command_permissions = True
-
-                        # check if command permissions are valid
-                        if command_permissions:
-                            self._logger.info('Received valid command %s', command_name)
-                            command['command_function'](command_param, test)
-                        else:
-                            first_name = update['message']['from']['first_name']
-                            last_name = update['message']['from']['last_name']
-                            self._logger.info('User %s %s requested command %s without permission',
-                                              first_name, last_name, command_name)
-                    else:
-                        # command not in list
-                        self._logger.info("Unrecognized command %s", command_name)
+            request = self._parse_command(update.get('message', {}), test, prefix, botfather_command)
+            if request is not None:
+                key = request[0]
+                if key in requests:
+                    self._logger.info('Coalescing duplicate command %s', request[1]['command_string'])
+                else:
+                    requests[key] = request
+
+        for request in requests.values():
+            self._dispatch_command(*request, test=test)
+
+    def _parse_command(self, message, test, prefix, botfather_command):
+        """
+        Returns the key, command, parameter, chat and message of a command message, None if the message
+        is no valid command for the bot from a configured group.
+        """
+        # check if message was sent in a configured group
+        chat = self._cfg.get_chat(message.get('chat', {}).get('id'), test)
+        if message.get('chat', {}).get('type') not in ['supergroup', 'group'] or chat is None:
+            return None
+        # check if message was for bot
+        text = message.get('text', '')
+        if not text.startswith(prefix):
+            return None
+
+        command_split = text.split(' ')
+        command_name = None
+        # work around for auto-generated picbot command
+        if len(command_split) == 1 and command_split[0] == botfather_command:
+            command_name = 'MakeMeHappy'
+        elif len(command_split) > 1:
+            command_name = command_split[1]
+
+        command_param = None
+        if len(command_split) == 3:
+            command_param = command_split[2]
+
+        # check if command is implemented
+        command = self._commands.get(command_name)
+        if command is None:
+            # command not in list
+            self._logger.info("Unrecognized command %s", command_name)
+            return None
+
+        key = (message['chat']['id'], command['command_string'], command_param)
+        if command['command_requires_admin']:
+            # permissions differ per user, so only the requests of the same user are identical
+            key += (message['from']['id'],)
+        return key, command, command_param, chat, message
+
+    def _dispatch_command(self, key, command, command_param, chat, message, test=False):
+        """
+        Runs the command on the worker pool. If the same request is still being processed, it is run once
+        more afterwards, however often it is received meanwhile.
+        """
+        request = (command, command_param, test, chat, message)
+        with self._running_commands_lock:
+            if key in self._running_commands:
+                self._logger.info('Command %s is already being processed, queueing it once more',
+                                  command['command_string'])
+                self._running_commands[key] = request
+                return
+            self._running_commands[key] = None
+
+        # blocks while too many commands are pending
+        self._command_slots.acquire()
+        self._submit_command(key, request)
+
+    def _submit_command(self, key, request):
+        """Runs the request on the worker pool, holding one of the command slots."""
+        future = self._command_pool.submit(self._run_command, *request)
+        future.add_done_callback(lambda future: self._finish_command(key, future))
+
+    def _finish_command(self, key, future):
+        """Runs the queued follow-up request or releases the slot of a processed command, and logs its failure."""
+        if not future.cancelled() and future.exception() is not None:
+            self._logger.error('Command failed: %s', future.exception())
+        with self._running_commands_lock:
+            request = self._running_commands.pop(key)
+            if request is not None:
+                self._running_commands[key] = None
+        if request is None:
+            self._command_slots.release()
+            return
+        try:
+            # the follow-up takes over the slot
+            self._submit_command(key, request)
+        except RuntimeError:
+            # the pool was shut down meanwhile
+            with self._running_commands_lock:
+                self._running_commands.pop(key, None)
+            self._command_slots.release()
+
+    def _run_command(self, command, command_param, test, chat, message):
+        """Checks the permissions of the sender and executes the command."""
+        # check if admin privileges are needed
+        command_permissions = True
+        if command['command_requires_admin'] is True:
+            # check if sender is admin
+            command_permissions = self._telegram_bot.is_admin(message['chat']['id'], message['from']['id'])
+
+        # check if command permissions are valid
+        if command_permissions:
+            self._logger.info('Received valid command %s', command['command_string'])
+            command['command_function'](command_param, test, chat)
+        else:
+            first_name = message['from'].get('first_name')
+            last_name = message['from'].get('last_name')
+            self._logger.info('User %s %s requested command %s without permission',
+                              first_name, last_name, command['command_string'])
 
-    def _make_me_happy(self, subreddit, test):
-        self.send_picture(subreddit, test)
+    def _make_me_happy(self, subreddit, test, chat):
+        self.send_picture(subreddit, test, chat)
 
-    def _get_source(self, parameter, test):
-        self.get_source(parameter, test)
+    def _get_source(self, parameter, test, chat):
+        self.get_source(parameter, test, chat)
 
 def main():
     """Main function"""
@@ -473,53 +2889,289 @@ def main():
     parser.add_argument("--send", action="store_true")
     parser.add_argument("--process_commands", action="store_true")
     parser.add_argument("--loop", action="store_true")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes sharing history and commands, each sending to its own groups")
+    parser.add_argument("--subreddits", nargs="+", help="subreddits of --send, default those of the chat")
+    parser.add_argument("--count", type=int, default=10, help="number of posts sent by --send")
+    parser.add_argument("--group", type=int, help="group id of the chat --send sends to, default the first chat")
     args = parser.parse_args()
 
+    if args.send:
+        picbot = Picturebot()
+        try:
+            chat = picbot.get_chat(args.group) if args.group is not None else None
+            if args.group is not None and chat is None:
+                print('Group %s is not configured. Exiting' % args.group)
+                exit(-1)
+            subreddits = args.subreddits or ([args.subreddit] if args.subreddit else None) or \
+                (chat or picbot.get_chats()[0])['subreddits']
+            report = picbot.send_batch(subreddits, args.count, args.test, chat)
+            print('Sent %(sent)s posts in %(seconds).1f seconds, %(skipped)s skipped, %(failed)s failed' % report)
+        finally:
+            picbot.close()
+        return
+
+    if args.loop and args.workers > 1:
+        if not Configuration().get_chat_triggers():
+            print('No triggers configured. Exiting')
+            exit(-1)
+        run_workers(args)
+        return
+
     picbot = Picturebot()
 
-    triggers = Configuration().get_triggers()
-    if triggers is None:
+    if not picbot.get_triggers():
         print('No triggers configured. Exiting')
         exit(-1)
 
-    if args.loop:
-        trigger_executed = [42 for x in triggers]
-        while True:
+    try:
+        if args.loop:
+            run_loop(picbot, args)
+    finally:
+        picbot.close()
+
+
+class Supervisor:
+    """
+    Runs components in threads and restarts a failed component with exponential backoff,
+    while the other components and the warm state they share keep running.
+    """
+
+    def __init__(self, min_backoff=1, max_backoff=300, on_failure=None):
+        self.logger = Logger.get_instance()
+        self.metrics = Metrics.get_instance()
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        # optional callable(name) called in the except block of a failed component
+        self.on_failure = on_failure
+        self._targets = collections.OrderedDict()
+        self._stops = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, target):
+        """Adds the component name, a callable(stop) running until the given stop event is set."""
+        self._targets[name] = target
+
+    def restart(self, name):
+        """Stops the component name, it is started again right away."""
+        with self._lock:
+            stop = self._stops.get(name)
+        if stop is not None:
+            stop.set()
+
+    def run(self, stop):
+        """Runs all components until the stop event is set."""
+        threads = [threading.Thread(target=self._supervise, args=(name, stop), name=name, daemon=True)
+                   for name in self._targets]
+        for thread in threads:
+            thread.start()
+        try:
+            # waiting in steps keeps the main thread responsive to KeyboardInterrupt
+            while not stop.wait(1):
+                pass
+        finally:
+            stop.set()
+            with self._lock:
+                for component_stop in self._stops.values():
+                    component_stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _supervise(self, name, stop):
+        """Runs the component name again and again until the stop event is set."""
+        failures = 0
+        while not stop.is_set():
+            component_stop = threading.Event()
+            with self._lock:
+                self._stops[name] = component_stop
+            started = time.monotonic()
+            try:
+                self._targets[name](component_stop)
+                continue
+            except Exception:  # pylint: disable=broad-except
+                self.metrics.inc('component_restarts_total', component=name)
+                self.logger.error('Component %s failed:\n%s', name, traceback.format_exc())
+                if self.on_failure is not None:
+                    self.on_failure(name)
+            # a component which ran longer than the maximum backoff failed anew
+            failures = 1 if time.monotonic() - started > self.max_backoff else failures + 1
+            delay = min(self.max_backoff, self.min_backoff * 2 ** (failures - 1))
+            self.logger.info('Restarting %s in %s seconds', name, delay)
+            stop.wait(delay)
+
+
+def run_loop(picbot, args, stop=None, connection=None):
+    """
+    Fires the configured triggers, long polls for commands and reloads the config, each as a component
+    of a supervisor, until the stop event is set.
+    With the connection of a worker process to its parent, the process polls the updates only while it is
+    the leader, sends them to the parent for the worker owning the group and processes those it receives.
+    """
+    def fire(trigger):
+        picbot.submit_picture(trigger.get('subreddit') or args.subreddit, args.test,
+                              picbot.get_chat(trigger['group_id']))
+
+    def run_triggers(component_stop):
+        # triggers are read on every start, so a restart applies changed triggers
+        TriggerScheduler(picbot.get_triggers(), fire, **picbot.get_scheduler_settings()).run(component_stop)
+
+    def run_commands(component_stop):
+        while not component_stop.is_set():
             picbot.process_commands(args.test)
-            time.sleep(1)
-            for idx, trigger in enumerate(triggers):
-                #check if regular send shall take place
-                time_now = datetime.now()
-                # configured days
-                if time_now.weekday() in trigger['days']:
-                    # configured hours
-                    if time_now.hour in trigger['hours']:
-                        # configured minutes
-                        if time_now.minute in trigger['minutes']:
-                            if trigger_executed[idx] != time_now.hour:
-                                trigger_executed[idx] = time_now.hour
-                                subreddit = args.subreddit
-                                if trigger.get("subreddit", None) is not None:
-                                    subreddit = trigger['subreddit']
-                                picbot.send_picture(subreddit, args.test)
-                        else:
-                            # reset trigger
-                            trigger_executed[idx] = 42
+
+    def run_leader(component_stop):
+        owner = '%s:%s' % (socket.gethostname(), os.getpid())
+        lease_ttl = picbot.get_cluster_settings()['lease_ttl']
+        try:
+            while not component_stop.is_set():
+                updates = picbot.lead_updates(owner, lease_ttl)
+                if updates is None:
+                    component_stop.wait(lease_ttl / 3)
+                    continue
+                for update in updates:
+                    chat = picbot.get_chat(update.get('message', {}).get('chat', {}).get('id'), args.test)
+                    if chat is not None:
+                        connection.send((picbot.get_owner(chat['group_id']), update))
+                # the updates are handed over, so a new leader continues after them
+                picbot.checkpoint_updates()
+        finally:
+            picbot.resign(owner)
+
+    def run_received_commands(component_stop):
+        while not component_stop.is_set():
+            if not connection.poll(1):
+                continue
+            # take the backlog at once, so duplicates are coalesced
+            updates = []
+            while connection.poll(0):
+                updates.append(connection.recv())
+            picbot.handle_updates(updates, args.test)
+
+    def run_config_reload(component_stop):
+        while not component_stop.wait(picbot.get_supervisor_settings()['reload_interval']):
+            changed = picbot.reload_config()
+            if changed & {'restart_min_backoff', 'restart_max_backoff'}:
+                restart_settings = picbot.get_supervisor_settings()
+                supervisor.min_backoff = restart_settings['min_backoff']
+                supervisor.max_backoff = restart_settings['max_backoff']
+            if changed & Picturebot.TRIGGER_KEYS:
+                supervisor.restart('triggers')
+
+    settings = picbot.get_supervisor_settings()
+    supervisor = Supervisor(settings['min_backoff'], settings['max_backoff'], picbot.report_failure)
+    supervisor.add('triggers', run_triggers)
+    if connection is None:
+        supervisor.add('commands', run_commands)
+    else:
+        supervisor.add('leader', run_leader)
+        supervisor.add('commands', run_received_commands)
+    supervisor.add('config', run_config_reload)
+
+    picbot.start_prefetching()
+    supervisor.run(stop if stop is not None else threading.Event())
+
+
+def run_workers(args):
+    """
+    Runs the loop of the bot in args.workers processes, each restarted with backoff if it dies.
+    The processes share history and update offset through SQLite. The commands polled by the leader
+    are routed by this process to the worker owning their group, through a pipe per worker.
+    """
+    context = multiprocessing.get_context('spawn')
+    # a pipe has a single reader and writer on each side, so a killed worker leaves no lock behind
+    connections = {}
+    lock = threading.Lock()
+
+    def run_process(index):
+        def run(component_stop):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target=run_worker, args=(index, args.workers, worker_connection, args),
+                                      name='worker%d' % index)
+            process.start()
+            worker_connection.close()
+            with lock:
+                connections[index] = connection
+            try:
+                while process.is_alive() and not component_stop.wait(1):
+                    pass
+            finally:
+                with lock:
+                    del connections[index]
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+                connection.close()
+            if not component_stop.is_set():
+                raise RuntimeError('Worker %d exited with %s' % (index, process.exitcode))
+        return run
+
+    def route(component_stop):
+        logger = Logger.get_instance()
+        while not component_stop.is_set():
+            with lock:
+                readable = list(connections.values())
+            if not readable:
+                component_stop.wait(1)
+                continue
+            for connection in multiprocessing.connection.wait(readable, timeout=1):
+                try:
+                    owner, update = connection.recv()
+                except (EOFError, OSError):
+                    # the worker died, its supervisor restarts it
+                    continue
+                with lock:
+                    target = connections.get(owner)
+                try:
+                    if target is None:
+                        raise OSError('worker %d is restarting' % owner)
+                    target.send(update)
+                except OSError as err:
+                    logger.error('Dropping update %s: %s', update.get('update_id'), err)
+
+    settings = Configuration().get_supervisor_settings()
+    supervisor = Supervisor(settings['min_backoff'], settings['max_backoff'])
+    for index in range(args.workers):
+        supervisor.add('worker%d' % index, run_process(index))
+    supervisor.add('router', route)
+    supervisor.run(threading.Event())
+
+
+def run_worker(index, count, connection, args):
+    """Runs the loop of worker process index of count, connected to its parent, until it is terminated."""
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    # every worker logs into its own file, appended to so a restart keeps the lines about the failure
+    Logger.filename = 'picturebot.%d.log' % index
+    Logger.filemode = 'a'
+    picbot = Picturebot(worker=(index, count))
+    try:
+        run_loop(picbot, args, stop, connection)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        picbot.close()
 
 
 if __name__ == '__main__':
+    # last resort if the bot cannot even be set up, components are restarted by the supervisor
+    restart_delay = 1
     while True:
         try:
             main()
+            break
         except Exception as e:
-            c = Configuration()
-            p = TelegramBot(c.get_bot_token())
-            admin_id = c.get_admin_id()
-            if admin_id is not None:
-                msg = 'Error occured, attempting to restart bot.\n' + str(traceback.format_exc())
-                p.send_message(admin_id, msg)
             with open('trace.log', 'w') as file_handle:
                 file_handle.write(str(datetime.now()))
                 file_handle.write('\n')
                 file_handle.write(str(traceback.format_exc()))
                 file_handle.write('\n')
+            try:
+                c = Configuration()
+                admin_id = c.get_admin_id()
+                if admin_id is not None:
+                    msg = 'Error occured, attempting to restart bot.\n' + str(traceback.format_exc())
+                    TelegramBot(c.get_bot_token()).send_message(admin_id, msg)
+            except Exception:  # pylint: disable=broad-except
+                pass
+            time.sleep(restart_delay)
+            restart_delay = min(restart_delay * 2, 300)
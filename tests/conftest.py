@@ -0,0 +1,11 @@
+"""Makes pic_bot importable from the repository root and keeps the test log out of the working directory."""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pic_bot  # pylint: disable=wrong-import-position
+
+pic_bot.Logger.filename = os.path.join(tempfile.gettempdir(), 'picturebot-tests.log')
@@ -0,0 +1,452 @@
+"""Behaviour checks of the picturebot building blocks which need no reddit or Telegram access."""
+
+from datetime import datetime
+import io
+import json
+import os
+import random
+import threading
+import time
+
+import pytest
+
+import pic_bot
+
+
+def test_cron_fields():
+    schedule = pic_bot.Schedule.from_cron('*/15 9-11 * * 1,5')
+    assert schedule.minutes == [0, 15, 30, 45]
+    assert schedule.hours == [9, 10, 11]
+    # monday and friday, counted from monday
+    assert schedule.weekdays == {0, 4}
+    assert schedule.days_of_month is None
+
+
+@pytest.mark.parametrize('expression', ['* * * *', '60 * * * *', '5-1 * * * *'])
+def test_cron_invalid(expression):
+    with pytest.raises(ValueError):
+        pic_bot.Schedule.from_cron(expression)
+
+
+def test_next_fire():
+    # 2024-01-01 is a monday
+    schedule = pic_bot.Schedule.from_cron('30 9 * * 1')
+    assert schedule.next_fire(datetime(2024, 1, 1, 9, 0)) == datetime(2024, 1, 1, 9, 30)
+    # strictly after the given time
+    assert schedule.next_fire(datetime(2024, 1, 1, 9, 30)) == datetime(2024, 1, 8, 9, 30)
+
+
+def test_next_fire_day_of_month_or_weekday():
+    # as in cron, the 15th or any sunday
+    schedule = pic_bot.Schedule.from_cron('0 12 15 * 0')
+    assert schedule.next_fire(datetime(2024, 1, 1)) == datetime(2024, 1, 7, 12, 0)
+    assert schedule.next_fire(datetime(2024, 1, 14, 12, 0)) == datetime(2024, 1, 15, 12, 0)
+
+
+def test_next_fire_never():
+    assert pic_bot.Schedule.from_cron('0 0 31 2 *').next_fire(datetime(2024, 1, 1)) is None
+
+
+def test_next_fire_times():
+    triggers = [{'cron': '0 9 * * *'}, {'minutes': [30], 'hours': [8], 'days': list(range(7))},
+                {'cron': '0 0 31 2 *'}]
+    scheduler = pic_bot.TriggerScheduler(triggers, callback=None)
+    stop = threading.Event()
+    stop.set()
+    scheduler.run(stop)
+
+    fire_times = scheduler.get_next_fire_times()
+    # the trigger which never fires is not scheduled
+    assert [idx for _, idx in fire_times] in ([1, 0], [0, 1])
+    assert fire_times[0][0] < fire_times[1][0]
+    assert all(fire_time > datetime.now() for fire_time, _ in fire_times)
+    assert {(fire_time.hour, fire_time.minute) for fire_time, _ in fire_times} == {(9, 0), (8, 30)}
+
+
+def test_title_filter_include_exclude():
+    title_filter = pic_bot.TitleFilter.from_config({'include': ['cat', 'dog'], 'exclude': ['.*sad']})
+    assert title_filter.matches('cat on a sofa')
+    assert title_filter.matches('dog')
+    assert not title_filter.matches('bird')
+    assert not title_filter.matches('cat looking sad')
+    assert pic_bot.TitleFilter.from_config('cat').matches('cats')
+    assert pic_bot.TitleFilter.from_config([]).matches('anything')
+
+
+def test_title_filter_inline_flags():
+    # the flags of one pattern do not apply to the other
+    title_filter = pic_bot.TitleFilter.from_config(['(?i)cat', 'Dog'])
+    assert title_filter.matches('CAT')
+    assert title_filter.matches('Dog')
+    assert not title_filter.matches('DOG')
+    assert pic_bot.TitleFilter.from_config('(?i)cat').matches('Cat')
+    # all stacked leading flags are scoped
+    title_filter = pic_bot.TitleFilter.from_config(['(?i)(?s)cat.dog', 'bird'])
+    assert title_filter.matches('CAT\nDOG')
+    assert not title_filter.matches('BIRD')
+
+
+def test_title_filter_groups():
+    # group numbers and names would clash in a single alternation
+    title_filter = pic_bot.TitleFilter.from_config([r'(a)\1', r'(b)\1'])
+    assert title_filter.matches('aa')
+    assert title_filter.matches('bb')
+    assert not title_filter.matches('ab')
+    title_filter = pic_bot.TitleFilter.from_config([r'(?P<animal>cat)s?', r'(?P<animal>dog)s?'])
+    assert title_filter.matches('dogs')
+    assert not title_filter.matches('birds')
+
+
+def test_title_filter_unscoped_flags():
+    title_filter = pic_bot.TitleFilter.from_config([r'(?a)\w+!', 'dog'])
+    assert isinstance(title_filter.include, pic_bot._PatternList)  # pylint: disable=protected-access
+    assert title_filter.matches('cat!')
+    assert not title_filter.matches('über!')
+    assert title_filter.matches('dog')
+
+
+def test_bk_tree_search():
+    tree = pic_bot.BKTree()
+    hashes = {'a': 0b0000, 'b': 0b0001, 'c': 0b0011, 'd': 0b1111, 'e': 0b0001, 'f': 0xFFFF << 48}
+    for item, value in hashes.items():
+        tree.add(value, item)
+    assert len(tree) == 6
+    assert sorted(tree.search(0b0000, 0)) == ['a']
+    assert sorted(tree.search(0b0000, 1)) == ['a', 'b', 'e']
+    assert sorted(tree.search(0b0001, 2)) == ['a', 'b', 'c', 'e']
+    assert tree.search(0b0111 << 30, 2) == []
+    assert pic_bot.BKTree().search(0, 64) == []
+
+
+def test_bk_tree_search_matches_linear_scan():
+    rng = random.Random(16)
+    values = [rng.getrandbits(64) for _ in range(300)]
+    tree = pic_bot.BKTree()
+    for idx, value in enumerate(values):
+        tree.add(value, idx)
+    for probe in values[:20] + [rng.getrandbits(64) for _ in range(20)]:
+        expected = [idx for idx, value in enumerate(values) if pic_bot.BKTree.distance(probe, value) <= 24]
+        assert sorted(tree.search(probe, 24)) == expected
+
+
+@pytest.mark.parametrize('shared', [False, True])
+def test_history_depth(tmp_path, shared):
+    filename = str(tmp_path / 'posts.db')
+    history = pic_bot.HistoryStore(filename, depth=3, legacy_filename=None, shared=shared)
+    assert history.add_many([('pics', 'p%d' % i) for i in range(5)]) == [('pics', 'p%d' % i) for i in range(5)]
+    assert history.add('cats', 'c0')
+    assert not history.add('pics', 'p4')
+    # only the newest depth posts are kept, per subreddit
+    assert history.get_posts('pics') == ['p2', 'p3', 'p4']
+    assert history.get_posts('cats') == ['c0']
+    assert not history.contains('pics', 'p1')
+    assert history.contains('pics', 'p2')
+    history.close()
+
+    reloaded = pic_bot.HistoryStore(filename, depth=3, legacy_filename=None, shared=shared)
+    assert reloaded.get_posts('pics') == ['p2', 'p3', 'p4']
+    assert reloaded.contains('cats', 'c0')
+    reloaded.close()
+
+
+def test_shared_history(tmp_path):
+    filename = str(tmp_path / 'posts.db')
+    first = pic_bot.HistoryStore(filename, depth=2, legacy_filename=None, shared=True)
+    second = pic_bot.HistoryStore(filename, depth=2, legacy_filename=None, shared=True)
+    assert first.add('pics', 'p0')
+    # claimed by the other store first
+    assert second.contains('pics', 'p0')
+    assert not second.add('pics', 'p0')
+    second.add_many([('pics', 'p1'), ('pics', 'p2')])
+    assert first.get_posts('pics') == ['p1', 'p2']
+    first.close()
+    second.close()
+
+
+def test_subreddit_selector_stats():
+    selector = pic_bot.SubredditSelector(cooldown=600, max_misses=2, exploration=0.0, smoothing=0.5)
+    selector.record_candidates('pics', checked=10, eligible=5, candidates=5)
+    selector.record_send('pics', found=True, latency=0.2)
+    selector.record_send('cats', found=False)
+    selector.record_send('cats', found=False)
+    pics = selector.get_stats('pics')
+    cats = selector.get_stats('cats')
+    assert pics['pass_rate'] == 0.75
+    assert pics['misses'] == 0
+    assert cats['misses'] == 0
+    assert cats['cooldown_until'] > pics['cooldown_until']
+    assert cats['success'] < pics['success']
+    # the cooling down subreddit is left out
+    assert {selector.select(['pics', 'cats']) for _ in range(20)} == {'pics'}
+
+
+def test_config_reload_invalid(tmp_path):
+    config_file = tmp_path / 'config.json'
+    config_file.write_text(json.dumps({'activation_prefix': '/old', 'group_id': -1, 'filter_regex': 'cat'}))
+    cfg = pic_bot.Configuration(str(config_file))
+    config_file.write_text(json.dumps({'activation_prefix': '/new', 'group_id': -2, 'filter_regex': '(cat'}))
+    os.utime(str(config_file), ns=(0, cfg._mtime + 1))  # pylint: disable=protected-access
+
+    # an invalid file changes nothing and is read again on the next reload
+    assert cfg.reload() == set()
+    assert cfg.get_activation_prefix() == '/old'
+    assert cfg.get_chat(-1) is not None
+    assert cfg.reload() == set()
+
+    config_file.write_text(json.dumps({'activation_prefix': '/new', 'group_id': -2, 'filter_regex': 'dog'}))
+    os.utime(str(config_file), ns=(0, cfg._mtime + 2))  # pylint: disable=protected-access
+    assert cfg.reload() == {'activation_prefix', 'group_id', 'filter_regex'}
+    assert cfg.get_chat(-1) is None
+    assert cfg.get_chat(-2) is not None
+    assert cfg.get_title_filter('pics').matches('dog')
+
+
+class FakeHttpClient:  # pylint: disable=too-few-public-methods
+    """Answers reddit requests with the queued (status, headers, body) responses and records the headers."""
+
+    def __init__(self, responses, on_request=None):
+        self.responses = list(responses)
+        self.requests = []
+        self.on_request = on_request
+
+    def get(self, url, headers=None):
+        self.requests.append(dict(headers or {}))
+        if self.on_request is not None:
+            self.on_request()
+        status, response_headers, body = self.responses.pop(0)
+        return pic_bot.HttpResponse(status, response_headers, body)
+
+
+LISTING = json.dumps({'data': {'after': 't3_b', 'children': [
+    {'data': {'id': 'a', 'title': 'cat', 'url': 'https://i.example/a.jpg', 'preview': {}}}]}}).encode('utf-8')
+
+
+def make_crawler(tmp_path, http_client, **kwargs):
+    history = pic_bot.HistoryStore(str(tmp_path / 'posts.db'), legacy_filename=None)
+    rate_limiter = pic_bot.RedditRateLimiter(rate=1000, capacity=1000, base_delay=0.01, max_delay=0.01)
+    return pic_bot.RedditCrawler(http_client=http_client, history=history, rate_limiter=rate_limiter, **kwargs)
+
+
+def test_listing_revalidation_of_dropped_entry(tmp_path):
+    http_client = FakeHttpClient([(200, {'ETag': '"v1"'}, LISTING)])
+    crawler = make_crawler(tmp_path, http_client, cache_ttl=0)
+    assert [post.post_id for post in crawler.get_subreddit_posts_from_api('pics').posts] == ['a']
+
+    # the listing is dropped while the conditional request is on its way
+    http_client.responses = [(304, {}, b''), (200, {'ETag': '"v2"'}, LISTING)]
+    http_client.on_request = crawler.cache._entries.clear  # pylint: disable=protected-access
+    listing = crawler.get_subreddit_posts_from_api('pics')
+    assert [post.post_id for post in listing.posts] == ['a']
+    assert http_client.requests[1]['If-None-Match'] == '"v1"'
+    assert 'If-None-Match' not in http_client.requests[2]
+
+
+@pytest.mark.parametrize('body', [b'<html>blocked</html>', b'[1, 2]', b'{"data": []}'])
+def test_invalid_listing(tmp_path, body):
+    crawler = make_crawler(tmp_path, FakeHttpClient([(200, {}, body)]))
+    with pytest.raises(pic_bot.RedditError):
+        crawler.get_subreddit_posts_from_api('pics')
+
+
+def test_no_backoff_after_last_attempt(tmp_path):
+    crawler = make_crawler(tmp_path, FakeHttpClient([(500, {}, b''), (500, {}, b'')]), max_retries=1)
+    backoffs = []
+    crawler.rate_limiter.backoff = lambda attempt, retry_after=None: backoffs.append(attempt) or 0
+    with pytest.raises(pic_bot.RedditError) as error:
+        crawler.get_subreddit_posts_from_api('pics')
+    assert error.value.status == 500
+    assert backoffs == [0]
+
+
+def test_file_id_cache(tmp_path):
+    filename = str(tmp_path / 'posts.db')
+    legacy_filename = str(tmp_path / 'file_ids.pickle')
+    pic_bot.NvMHandler().store({'url0': 'id0', 'url1': 'id1'}, legacy_filename)
+    cache = pic_bot.FileIdCache(filename, max_size=3, legacy_filename=legacy_filename)
+    assert cache.get('url0') == 'id0'
+    cache.put('url2', 'id2')
+    # url1 is the least recently used entry
+    cache.put('url3', 'id3')
+    assert cache.get('url1') is None
+    assert [cache.get(url) for url in ('url0', 'url2', 'url3')] == ['id0', 'id2', 'id3']
+    cache.discard('url2')
+    assert cache.get('url2') is None
+
+    # shared with the other processes, the pickled cache is imported only once
+    other = pic_bot.FileIdCache(filename, max_size=3, legacy_filename=legacy_filename)
+    assert other.get('url1') is None
+    other.put('url4', 'id4')
+    assert cache.get('url4') == 'id4'
+    cache.close()
+    other.close()
+
+
+def test_near_duplicate_hash_failure_is_retried(tmp_path):
+    image = pytest.importorskip('PIL.Image')
+    thumbnail = io.BytesIO()
+    image.new('L', (16, 16), 128).save(thumbnail, 'PNG')
+    http_client = FakeHttpClient([(500, {}, b''), (200, {}, thumbnail.getvalue())])
+    near_duplicates = pic_bot.NearDuplicateFilter(http_client, str(tmp_path / 'posts.db'), workers=1)
+    post = pic_bot.Post('a', 'cat', 'https://i.example/a.jpg', False, 'pics', thumbnail_url='https://i.example/a.png')
+
+    near_duplicates.hash_posts([post])
+    assert post.media_hash is None
+    # the failure is not retried right away
+    near_duplicates.hash_posts([post])
+    assert len(http_client.requests) == 1
+
+    near_duplicates._failures[post.thumbnail_url] = 0  # pylint: disable=protected-access
+    near_duplicates.hash_posts([post])
+    assert post.media_hash is not None
+    assert near_duplicates.add(post)
+    near_duplicates.close()
+
+
+class FakeTelegramBot:  # pylint: disable=too-few-public-methods
+    """Returns the queued update batches and records the requested offsets."""
+
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.offsets = []
+
+    def get_updates(self, offset, timeout):
+        self.offsets.append(offset)
+        return self.batches.pop(0) if self.batches else []
+
+
+class CountingNvMHandler(pic_bot.NvMHandler):
+    """Records the stored values."""
+
+    def __init__(self):
+        super().__init__()
+        self.stored = []
+
+    def store(self, data, filename):
+        self.stored.append(data)
+        super().store(data, filename)
+
+
+def updates(*update_ids):
+    return [{'update_id': update_id} for update_id in update_ids]
+
+
+def test_update_offsets_and_checkpoints(tmp_path):
+    filename = str(tmp_path / 'update_id.pickle')
+    bot = FakeTelegramBot([updates(10, 11), updates(12), [], updates(13, 14)])
+    nvm = CountingNvMHandler()
+    consumer = pic_bot.UpdateConsumer(bot, nvm, timeout=0, checkpoint_interval=3, filename=filename)
+    assert consumer.last_update_id is None
+
+    assert consumer.poll() == updates(10, 11)
+    assert nvm.stored == []
+    assert consumer.poll() == updates(12)
+    # checkpointed every checkpoint_interval updates
+    assert nvm.stored == [12]
+    assert consumer.poll() == []
+    assert consumer.poll() == updates(13, 14)
+    assert nvm.stored == [12]
+    # each poll continues after the last consumed update
+    assert bot.offsets == [None, 12, 13, 13]
+
+    consumer.checkpoint()
+    consumer.checkpoint()
+    assert nvm.stored == [12, 14]
+    resumed = pic_bot.UpdateConsumer(FakeTelegramBot([]), nvm, filename=filename)
+    assert resumed.last_update_id == 14
+    resumed.poll()
+    assert resumed.telegram_bot.offsets == [15]
+
+
+def test_update_offset_shared(tmp_path):
+    state = pic_bot.SharedState(str(tmp_path / 'posts.db'))
+    consumer = pic_bot.UpdateConsumer(FakeTelegramBot([updates(7)]), pic_bot.NvMHandler(),
+                                      checkpoint_interval=50, state=state)
+    consumer.poll()
+    assert state.get('update_id') is None
+    consumer.checkpoint()
+    assert state.get('update_id') == 7
+
+    # another process consumed further updates meanwhile
+    state.set('update_id', 9)
+    consumer.resume()
+    assert consumer.last_update_id == 9
+    consumer.poll()
+    assert consumer.telegram_bot.offsets[-1] == 10
+    state.close()
+
+
+@pytest.fixture
+def picbot(tmp_path, monkeypatch):
+    """A bot of a single group, whose files are written to a temporary directory and which never polls."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'config.json').write_text(json.dumps({'bot_token': '1:test', 'group_id': -1, 'test_group_id': -2,
+                                                      'subreddits': ['pics'], 'command_workers': 1}))
+    bot = pic_bot.Picturebot(str(tmp_path / 'config.json'))
+    yield bot
+    bot.close()
+
+
+def command_update(update_id, text, user_id=42):
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'text': text, 'chat': {'id': -1, 'type': 'group'},
+                        'from': {'id': user_id, 'first_name': 'Test'}}}
+
+
+def test_command_coalescing(picbot):  # pylint: disable=redefined-outer-name
+    started = threading.Semaphore(0)
+    release = threading.Event()
+    runs = []
+
+    def block(parameter, test, chat):
+        runs.append(parameter)
+        started.release()
+        assert release.wait(5)
+
+    picbot._commands.register('block', block)  # pylint: disable=protected-access
+
+    # duplicates in one poll run once
+    picbot.handle_updates([command_update(1, '/picbot block a'), command_update(2, '/picbot block a')])
+    assert started.acquire(timeout=5)
+    # repeats during the run queue a single follow-up
+    picbot.handle_updates([command_update(3, '/picbot block a')])
+    picbot.handle_updates([command_update(4, '/picbot block a')])
+    assert runs == ['a']
+
+    release.set()
+    assert started.acquire(timeout=5)
+    deadline = time.monotonic() + 5
+    while picbot._running_commands and time.monotonic() < deadline:  # pylint: disable=protected-access
+        time.sleep(0.01)
+    assert runs == ['a', 'a']
+    assert not picbot._running_commands  # pylint: disable=protected-access
+    # all slots are free again
+    slots = picbot._command_slots  # pylint: disable=protected-access
+    free = 0
+    while slots.acquire(blocking=False):
+        free += 1
+    assert free == 4
+
+
+def test_leader_lease(tmp_path):
+    filename = str(tmp_path / 'posts.db')
+    first = pic_bot.SharedState(filename)
+    second = pic_bot.SharedState(filename)
+    assert first.acquire_lease('updates', 'worker-0', ttl=0.5)
+    assert not second.acquire_lease('updates', 'worker-1', ttl=0.5)
+    # the holder renews its lease
+    time.sleep(0.3)
+    assert first.acquire_lease('updates', 'worker-0', ttl=0.5)
+    time.sleep(0.3)
+    assert not second.acquire_lease('updates', 'worker-1', ttl=0.5)
+
+    # taken over once the lease expired
+    time.sleep(0.4)
+    assert second.acquire_lease('updates', 'worker-1', ttl=0.5)
+    assert not first.acquire_lease('updates', 'worker-0', ttl=0.5)
+    # only the holder can release it
+    first.release_lease('updates', 'worker-0')
+    assert not first.acquire_lease('updates', 'worker-0', ttl=0.5)
+    second.release_lease('updates', 'worker-1')
+    assert first.acquire_lease('updates', 'worker-0', ttl=0.5)
+    first.close()
+    second.close()